@@ -0,0 +1,82 @@
+import os
+import pickle
+import sqlite3
+import hashlib
+from contextlib import closing
+
+AST_CACHE_DIR = "./.ast_cache"
+
+# Bump when the extraction logic changes so results cached by older code are ignored
+AST_CACHE_VERSION = 1
+
+class ASTCache:
+    """Cache of per-file AST extraction results keyed by a hash of the file's path and contents."""
+
+    def __init__(self, cache_dir=AST_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest_path = os.path.join(cache_dir, "manifest.sqlite3")
+
+        # The manifest maps each file to its current hash, so changed and deleted files can be detected
+        with closing(sqlite3.connect(self.manifest_path)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+
+    def key(self, file_path, code):
+        """Hash a file's path and contents; the path is included because results record the filename"""
+        digest = hashlib.sha1(f"{AST_CACHE_VERSION}\0{file_path}\0".encode('utf8'))
+        digest.update(code)
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Return the cached results for a key, or None on a miss"""
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def store(self, key, file_results):
+        """Cache the results for a key"""
+        # Write to a temporary file first so an interrupted run never leaves a truncated entry
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(file_results, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, entry_path)
+
+    def sync_manifest(self, source_dir, file_keys):
+        """
+        Record the current hash of every file under source_dir and drop entries that went stale.
+
+        Args:
+            source_dir: Absolute directory that was scanned
+            file_keys: Mapping of file path to cache key for every file found in source_dir
+
+        Returns:
+            List of previously cached file paths that no longer exist
+        """
+        prefix = os.path.join(source_dir, "")
+        with closing(sqlite3.connect(self.manifest_path)) as conn, conn:
+            previous = {
+                path: key for path, key in conn.execute("SELECT path, hash FROM files")
+                if path.startswith(prefix)
+            }
+
+            # Remove entries for deleted files and for the old contents of changed files
+            for path, key in previous.items():
+                if file_keys.get(path) != key:
+                    self._remove_entry(key)
+            deleted_paths = [path for path in previous if path not in file_keys]
+            conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in deleted_paths])
+            conn.executemany("INSERT OR REPLACE INTO files (path, hash) VALUES (?, ?)", file_keys.items())
+
+        return deleted_paths
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def _remove_entry(self, key):
+        try:
+            os.remove(self._entry_path(key))
+        except FileNotFoundError:
+            pass
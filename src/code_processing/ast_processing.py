@@ -1,33 +1,38 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 from tree_sitter import Language, Parser
 import tree_sitter_c_sharp as tscsharp
+from code_processing.ast_cache import ASTCache, AST_CACHE_DIR
+
+# Below this many files the process pool start-up costs more than parallel parsing saves
+MIN_FILES_FOR_PARALLEL_PARSING = 8
+
+NAMESPACE_NODE_TYPES = ('namespace_declaration',)
+CLASS_NODE_TYPES = ('class_declaration', 'struct_declaration')
 
 class CSharpASTProcessor:
-    def __init__(self):
+    def __init__(self, cache_dir=AST_CACHE_DIR):
+        # Directory of the per-file result cache; None disables caching
+        self.cache_dir = cache_dir
+
         # Compile the C# language for Tree-sitter
         self.CSHARP_LANGUAGE = Language(tscsharp.language())
         self.parser = Parser(self.CSHARP_LANGUAGE)
 
-        # Tree-sitter queries for C# namespaces, classes, and methods
-        self.namespace_query = self.CSHARP_LANGUAGE.query("""
+        # A single Tree-sitter query for C# namespaces, classes, structs and methods, so each file is walked once
+        self.definition_query = self.CSHARP_LANGUAGE.query("""
             (namespace_declaration
                 name: [(identifier) (qualified_name)] @namespace.name
             ) @namespace.def
-        """)
 
-        self.class_query = self.CSHARP_LANGUAGE.query("""
             (class_declaration
                 name: (identifier) @class.name
             ) @class.def
-        """)
 
-        self.struct_query = self.CSHARP_LANGUAGE.query("""
             (struct_declaration
                 name: (identifier) @struct.name
             ) @struct.def
-        """)
 
-        self.method_query = self.CSHARP_LANGUAGE.query("""
             (method_declaration
                 name: (identifier) @method.name
             ) @method.def
@@ -35,73 +40,139 @@ class CSharpASTProcessor:
 
     def process_source_dir(self, source_dir):
         """Iterate over .cs files in the source directory and extract data"""
+        source_dir = os.path.normpath(os.path.abspath(source_dir))
+        file_paths = [
+            os.path.join(root, file)
+            for root, _, files in os.walk(source_dir)
+            for file in files
+            if file.endswith(".cs")
+        ]
+
+        # Reuse cached results for unchanged files and only parse new or modified ones
+        cache = ASTCache(self.cache_dir) if self.cache_dir else None
+        file_results_by_path = {}
+        file_keys = {}
+        files_to_parse = []
+        for file_path in file_paths:
+            # Tree-sitter parses bytes, so skip decoding the file; only the captured node texts are decoded
+            with open(file_path, 'rb') as f:
+                code = f.read()
+
+            if cache:
+                file_keys[file_path] = cache.key(file_path, code)
+                cached_results = cache.load(file_keys[file_path])
+                if cached_results is not None:
+                    file_results_by_path[file_path] = cached_results
+                    continue
+            files_to_parse.append((file_path, code))
+
+        for (file_path, _), file_results in zip(files_to_parse, self._parse_files(files_to_parse)):
+            file_results_by_path[file_path] = file_results
+            if cache:
+                cache.store(file_keys[file_path], file_results)
+
+        if cache:
+            deleted_paths = cache.sync_manifest(source_dir, file_keys)
+            print(f"Reused cached AST results for {len(file_paths) - len(files_to_parse)} of {len(file_paths)} files")
+            if deleted_paths:
+                print(f"Dropped cached AST results for {len(deleted_paths)} deleted files")
+
         results = {'namespaces': [], 'classes': [], 'methods': []}
-        for root, _, files in os.walk(os.path.normpath(os.path.abspath(source_dir))):
-            for file in files:
-                if file.endswith(".cs"):
-                    file_path = os.path.join(root, file)
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        code = f.read()
-
-                    print(f"\nProcessing file: {file_path}")
-                    file_results = self._parse_abstract_syntax_tree(file_path, code)
-                    results['namespaces'].extend(file_results['namespaces'])
-                    results['classes'].extend(file_results['classes'])
-                    results['methods'].extend(file_results['methods'])
+        for file_path in file_paths:
+            self._merge_results(results, file_results_by_path[file_path])
 
         return results
 
+    def parse_source(self, file_path, code):
+        """Extract namespaces, classes and methods from the UTF-8 encoded contents of a .cs file"""
+        print(f"\nProcessing file: {file_path}")
+        return self._parse_abstract_syntax_tree(file_path, code)
+
+    def _parse_files(self, files):
+        """Parse (file_path, code) pairs, in parallel when there are enough of them"""
+        if len(files) > MIN_FILES_FOR_PARALLEL_PARSING:
+            # Files parse independently, so spread them over all cores
+            max_workers = os.cpu_count() or 1
+            chunksize = max(1, min(32, len(files) // (max_workers * 4)))
+            file_paths, codes = zip(*files)
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+                return list(executor.map(_parse_source_in_worker, file_paths, codes, chunksize=chunksize))
+
+        return [self.parse_source(file_path, code) for file_path, code in files]
+
+    def _merge_results(self, results, file_results):
+        """Append the results of one file to the combined results"""
+        results['namespaces'].extend(file_results['namespaces'])
+        results['classes'].extend(file_results['classes'])
+        results['methods'].extend(file_results['methods'])
+
     def _parse_abstract_syntax_tree(self, filename, code):
-        """Parse C# code and extract namespace definitions"""
-        tree = self.parser.parse(code.encode('utf8'))
-        root_node = tree.root_node
+        """Parse UTF-8 encoded C# code and extract namespace, class and method definitions"""
+        tree = self.parser.parse(code)
         results = {'namespaces': [], 'classes': [], 'methods': []}
 
-        for _, match in self.namespace_query.matches(root_node):
+        for _, match in self.definition_query.matches(tree.root_node):
             captures = {name: node[0] for name, node in match.items()}
-            namespace_name = captures['namespace.name'].text.decode('utf8')
-            results['namespaces'].append({
-                'name': namespace_name,
-            })
-            self._extract_classes(filename, captures['namespace.def'], results)
+            if 'namespace.def' in captures:
+                results['namespaces'].append({
+                    'name': captures['namespace.name'].text.decode('utf8'),
+                })
+            elif 'class.def' in captures or 'struct.def' in captures:
+                self._extract_class(filename, captures, results)
+            elif 'method.def' in captures:
+                self._extract_method(captures, results)
 
         return results
 
-    def _extract_classes(self, filename, namespaceNode, results):
-        """Extract class definitions from a namespace node"""
-        for _, match in self.class_query.matches(namespaceNode) + self.struct_query.matches(namespaceNode):
-            captures = {name: node[0] for name, node in match.items()}
-            if 'class.name' in captures:
-                class_name = captures['class.name'].text.decode('utf8')
-                node_def = captures['class.def']
-            elif 'struct.name' in captures:
-                class_name = captures['struct.name'].text.decode('utf8')
-                node_def = captures['struct.def']
-            else:
-                continue
-            results['classes'].append({
-                'name': class_name,
-                'filename': filename,
-                'docstring': self._extract_docstring(node_def),
-                'namespace': namespaceNode.children_by_field_name('name')[0].text.decode('utf8')
-            })
-            self._extract_methods(filename, class_name, node_def, results)
-
-    def _extract_methods(self, filename, className, classNode, results):
-        """Extract method definitions from a class node"""
-        for _, match in self.method_query.matches(classNode):
-            captures = {name: node[0] for name, node in match.items()}
-            method_name = captures['method.name'].text.decode('utf8')
-            method_code = captures['method.def'].text.decode('utf8')
-            results['methods'].append({
-                'name': method_name,
-                'docstring': self._extract_docstring(captures['method.def']),
-                'class': className,
-                'code': method_code
-            })
+    def _extract_class(self, filename, captures, results):
+        """Extract a class or struct definition, attributed to its innermost namespace"""
+        kind = 'class' if 'class.def' in captures else 'struct'
+        node_def = captures[f'{kind}.def']
+        namespace_node = self._find_ancestor(node_def, NAMESPACE_NODE_TYPES)
+        if namespace_node is None:
+            return
+        results['classes'].append({
+            'name': captures[f'{kind}.name'].text.decode('utf8'),
+            'filename': filename,
+            'docstring': self._extract_docstring(node_def),
+            'namespace': namespace_node.child_by_field_name('name').text.decode('utf8')
+        })
+
+    def _extract_method(self, captures, results):
+        """Extract a method definition, attributed to its innermost class or struct"""
+        method_def = captures['method.def']
+        class_node = self._find_ancestor(method_def, CLASS_NODE_TYPES)
+        # Only methods of classes that were extracted, i.e. those declared inside a namespace
+        if class_node is None or self._find_ancestor(class_node, NAMESPACE_NODE_TYPES) is None:
+            return
+        results['methods'].append({
+            'name': captures['method.name'].text.decode('utf8'),
+            'docstring': self._extract_docstring(method_def),
+            'class': class_node.child_by_field_name('name').text.decode('utf8'),
+            'code': method_def.text.decode('utf8')
+        })
+
+    def _find_ancestor(self, node, node_types):
+        """Return the nearest ancestor whose type is one of node_types, or None"""
+        node = node.parent
+        while node is not None and node.type not in node_types:
+            node = node.parent
+        return node
 
     def _extract_docstring(self, node):
         """Extracts comments above a method as docstring."""
         if node.prev_sibling and node.prev_sibling.type == "comment":
             return node.prev_sibling.text.decode("utf-8")
-        return ""
\ No newline at end of file
+        return ""
+
+# Processor owned by a pool worker; tree-sitter parsers are created after the fork rather than inherited
+_worker_processor = None
+
+def _init_worker():
+    """Create the per-process processor when a pool worker starts"""
+    global _worker_processor
+    _worker_processor = CSharpASTProcessor(cache_dir=None)
+
+def _parse_source_in_worker(file_path, code):
+    """Parse one file with the worker's processor"""
+    return _worker_processor.parse_source(file_path, code)
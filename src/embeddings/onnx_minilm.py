@@ -0,0 +1,174 @@
+import os
+import logging
+import threading
+import numpy as np
+from functools import lru_cache
+from typing import List, Tuple
+from langchain.embeddings.base import Embeddings
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+
+logger = logging.getLogger("rag_chatbot.embeddings")
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), ".onnx", "all-MiniLM-L6-v2")
+
+# Short code and question samples used to check that quantization does not move the embeddings
+DRIFT_PROBE_TEXTS = [
+    "How does the Option monad handle missing values?",
+    "public static Option<T> Some<T>(T value) => new Option<T>(value);",
+    "Which classes are in the Layumba namespace?",
+    "public Either<L, R> Bind<R>(Func<T, Either<L, R>> f) { return IsRight ? f(Right) : Left; }",
+    "Where is partial application implemented?",
+]
+
+def _export_onnx_model(model_name: str, onnx_dir: str) -> None:
+    """Export the model and tokenizer to ONNX unless a previous export exists."""
+    if os.path.exists(os.path.join(onnx_dir, "model.onnx")):
+        return
+    logger.info(f"Exporting {model_name} to ONNX in {onnx_dir}")
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True, provider="CPUExecutionProvider")
+    model.save_pretrained(onnx_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(onnx_dir)
+
+def _quantize_onnx_model(onnx_dir: str) -> None:
+    """Write an int8 dynamically quantized copy of the exported model unless one exists."""
+    if os.path.exists(os.path.join(onnx_dir, "model_quantized.onnx")):
+        return
+    logger.info(f"Quantizing ONNX model in {onnx_dir} to int8")
+    quantizer = ORTQuantizer.from_pretrained(onnx_dir, file_name="model.onnx")
+    # Per-channel int8 weights targeting the AVX-512 VNNI dot-product kernels
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+    quantizer.quantize(save_dir=onnx_dir, quantization_config=qconfig)
+
+@lru_cache(maxsize=None)
+def _load_onnx_model(model_name: str, onnx_dir: str, quantize: bool, max_cosine_drift: float,
+                     max_seq_length: int) -> Tuple[PreTrainedTokenizerBase, ORTModelForFeatureExtraction]:
+    """Load the tokenizer and ONNX Runtime session, exporting the model on first use. Cached per process."""
+    _export_onnx_model(model_name, onnx_dir)
+    tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+    model = ORTModelForFeatureExtraction.from_pretrained(onnx_dir, file_name="model.onnx", provider="CPUExecutionProvider")
+    if not quantize:
+        return tokenizer, model
+
+    _quantize_onnx_model(onnx_dir)
+    quantized_model = ORTModelForFeatureExtraction.from_pretrained(
+        onnx_dir, file_name="model_quantized.onnx", provider="CPUExecutionProvider"
+    )
+
+    # Only swap in the int8 model if it reproduces the FP32 embeddings closely enough
+    reference = _mean_pooled_embeddings(tokenizer, model, DRIFT_PROBE_TEXTS, max_seq_length)
+    candidate = _mean_pooled_embeddings(tokenizer, quantized_model, DRIFT_PROBE_TEXTS, max_seq_length)
+    drift = float(np.max(1.0 - np.sum(reference * candidate, axis=1)))
+    if drift > max_cosine_drift:
+        logger.warning(f"Quantized model cosine drift {drift:.2e} exceeds {max_cosine_drift:.0e} - using FP32 model")
+        return tokenizer, model
+
+    logger.info(f"Using int8 quantized model (cosine drift {drift:.2e})")
+    return tokenizer, quantized_model
+
+def _mean_pooled_embeddings(tokenizer: PreTrainedTokenizerBase, model: ORTModelForFeatureExtraction,
+                            texts: List[str], max_seq_length: int) -> np.ndarray:
+    """Run one batch through the model and apply MiniLM's mean pooling and normalization."""
+    inputs = tokenizer(texts, padding=True, truncation=True, max_length=max_seq_length, return_tensors="np")
+    token_embeddings = model(**inputs).last_hidden_state
+
+    mask = inputs["attention_mask"][..., None].astype(token_embeddings.dtype)
+    embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    return embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+
+class OnnxMiniLMEmbeddings(Embeddings):
+    """LangChain embeddings for all-MiniLM-L6-v2 running on ONNX Runtime instead of PyTorch."""
+
+    def __init__(self,
+                 model_name: str = MODEL_NAME,
+                 onnx_dir: str = ONNX_DIR,
+                 max_seq_length: int = 256,
+                 quantize: bool = True,
+                 max_cosine_drift: float = 1e-3,
+                 query_cache_size: int = 4096):
+        """
+        Initialize the embeddings.
+
+        Args:
+            model_name: Hugging Face model to export
+            onnx_dir: Directory where the exported ONNX model is cached
+            max_seq_length: Maximum number of tokens per input (the sentence-transformers default for MiniLM)
+            quantize: Whether to use an int8 dynamically quantized copy of the model
+            max_cosine_drift: Largest cosine distance to the FP32 embeddings on the probe texts
+                for which the quantized model is accepted
+            query_cache_size: Number of query embeddings kept in the LRU cache
+        """
+        self.tokenizer, self.model = _load_onnx_model(model_name, onnx_dir, quantize, max_cosine_drift, max_seq_length)
+        self.max_seq_length = max_seq_length
+        self.dimension = self.model.config.hidden_size
+        self._lowercase = getattr(self.tokenizer, "do_lower_case", False)
+        # The fast tokenizer keeps its padding/truncation settings in shared Rust state that every call with
+        # different settings rewrites, so concurrent calls from worker threads fail ("Already borrowed") or
+        # tokenize with another call's settings. All tokenizer calls and model runs hold this lock
+        self._lock = threading.Lock()
+        self._embed_query_cached = lru_cache(maxsize=query_cache_size)(self._embed_normalized_query)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of documents."""
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single query, reusing the cached embedding for repeated questions."""
+        return list(self._embed_query_cached(self._normalize_query(text)))
+
+    def count_tokens(self, texts: List[str], add_special_tokens: bool = True) -> List[int]:
+        """
+        Count the tokens of each text, without truncation.
+
+        Args:
+            texts: Texts to tokenize
+            add_special_tokens: Whether to count the [CLS]/[SEP] tokens added to every model input
+
+        Returns:
+            Number of tokens per text
+        """
+        with self._lock:
+            token_ids = self.tokenizer(texts, add_special_tokens=add_special_tokens)["input_ids"]
+        return [len(ids) for ids in token_ids]
+
+    def clear_query_cache(self) -> None:
+        """Drop all cached query embeddings."""
+        self._embed_query_cached.cache_clear()
+
+    def _normalize_query(self, text: str) -> str:
+        """Build the cache key; whitespace (and case, for an uncased tokenizer) does not change the tokens."""
+        text = " ".join(text.split())
+        return text.lower() if self._lowercase else text
+
+    def _embed_normalized_query(self, text: str) -> Tuple[float, ...]:
+        """Embed a normalized query as a tuple so the cached value cannot be mutated by callers."""
+        return tuple(self.encode([text])[0].tolist())
+
+    def encode(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        """
+        Embed texts in batches of similar token length.
+
+        Args:
+            texts: Texts to embed
+            batch_size: Number of texts per ONNX Runtime call
+
+        Returns:
+            Array of L2-normalized embeddings in input order
+        """
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+
+        with self._lock:
+            # Every batch is padded to its longest sequence, so bucketing by token count avoids encoding pad tokens
+            token_ids = self.tokenizer(texts, add_special_tokens=False, truncation=True, max_length=self.max_seq_length)["input_ids"]
+            order = np.argsort([len(ids) for ids in token_ids], kind="stable")
+
+            sorted_embeddings = np.concatenate([
+                _mean_pooled_embeddings(
+                    self.tokenizer, self.model, [texts[i] for i in order[start:start + batch_size]], self.max_seq_length
+                )
+                for start in range(0, len(texts), batch_size)
+            ])
+        return sorted_embeddings[np.argsort(order)]
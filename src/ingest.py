@@ -1,38 +1,116 @@
+import asyncio
+import os
+import chromadb
+from uuid import uuid4
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.schema import Document
-from py2neo import Graph, Node, Relationship
+from neo4j import GraphDatabase
 from code_processing.ast_processing import CSharpASTProcessor
+from embeddings.onnx_minilm import OnnxMiniLMEmbeddings
+from retrieval.vector_search import hnsw_collection_metadata, qualname
 
-def insert_into_neo4j(graph_data):
-    NEO4J_URI = "bolt://localhost:7687"
-    graph_db = Graph(NEO4J_URI, auth=("neo4j", "password"))
-    tx = graph_db.begin()
-    
-    for namespace in graph_data['namespaces']:
-        namespace_node = Node("Namespace", name=namespace['name'])
-        tx.merge(namespace_node, "Namespace", "name")
+# Set CHROMA_HOST to ingest into a Chroma server (chroma run --path ./db --port 8001) instead of ./db
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8001"))
 
-    for cls in graph_data['classes']:
-        class_node = Node("Class", name=cls['name'], filename=cls['filename'], docstring=cls['docstring'])
-        tx.merge(class_node, "Class", "name")
+# Methods longer than this many characters are split into chunks of METHOD_CHUNK_SIZE
+MAX_METHOD_CHUNK_LENGTH = 2000
+METHOD_CHUNK_SIZE = 1500
+METHOD_CHUNK_OVERLAP = 150
 
-        # Create relationship between class and its namespace
-        namespace_node = Node("Namespace", name=cls['namespace'])
-        tx.merge(namespace_node, "Namespace", "name")
-        tx.merge(Relationship(namespace_node, "CONTAINS", class_node))
+# Rows sent per UNWIND statement, bounding the size of each parameter payload
+NEO4J_BATCH_SIZE = 1000
 
-    for method in graph_data['methods']:
-        method_node = Node("Method", name=method['name'], docstring=method['docstring'], code=method['code'])
-        tx.merge(method_node, "Method", "name")
+# Unique names make every MERGE below an index lookup instead of a label scan
+NEO4J_CONSTRAINTS = [
+    "CREATE CONSTRAINT namespace_name IF NOT EXISTS FOR (n:Namespace) REQUIRE n.name IS UNIQUE",
+    "CREATE CONSTRAINT class_name IF NOT EXISTS FOR (c:Class) REQUIRE c.name IS UNIQUE",
+    "CREATE CONSTRAINT method_name IF NOT EXISTS FOR (m:Method) REQUIRE m.name IS UNIQUE"
+]
+
+# Text indexes serve CONTAINS searches; they cover lowercased copies since toLower() on a property bypasses indexes
+NEO4J_TEXT_INDEXES = [
+    "CREATE TEXT INDEX method_name_lower IF NOT EXISTS FOR (m:Method) ON (m.name_lower)",
+    "CREATE TEXT INDEX method_docstring_lower IF NOT EXISTS FOR (m:Method) ON (m.docstring_lower)"
+]
+
+MERGE_NAMESPACES_QUERY = """
+UNWIND $rows AS row
+MERGE (n:Namespace {name: row.name})
+"""
+
+MERGE_CLASSES_QUERY = """
+UNWIND $rows AS row
+MERGE (c:Class {name: row.name})
+SET c.filename = row.filename, c.docstring = row.docstring
+"""
+
+MERGE_METHODS_QUERY = """
+UNWIND $rows AS row
+MERGE (m:Method {name: row.name})
+SET m.docstring = row.docstring, m.code = row.code,
+    m.name_lower = toLower(row.name), m.docstring_lower = toLower(row.docstring)
+"""
+
+MERGE_NAMESPACE_CLASSES_QUERY = """
+UNWIND $rows AS row
+MERGE (n:Namespace {name: row.namespace})
+MERGE (c:Class {name: row.`class`})
+MERGE (n)-[:CONTAINS]->(c)
+"""
+
+MERGE_CLASS_METHODS_QUERY = """
+UNWIND $rows AS row
+MERGE (c:Class {name: row.`class`})
+MERGE (m:Method {name: row.method})
+MERGE (c)-[:CONTAINS]->(m)
+"""
+
+def insert_into_neo4j(graph_data):
+    NEO4J_URI = "bolt://localhost:7687"
+    with GraphDatabase.driver(NEO4J_URI, auth=("neo4j", "password")) as driver:
+        with driver.session() as session:
+            # Schema changes cannot share a transaction with writes
+            for schema_statement in NEO4J_CONSTRAINTS + NEO4J_TEXT_INDEXES:
+                session.run(schema_statement).consume()
+            session.execute_write(merge_graph_data, deduplicate_graph_data(graph_data))
 
-        # Create relationship between method and its class
-        class_node = Node("Class", name=method['class'])
-        tx.merge(class_node, "Class", "name")
-        tx.merge(Relationship(class_node, "CONTAINS", method_node))
+def deduplicate_graph_data(graph_data):
+    """Collapse repeated nodes and relationships so each is merged exactly once."""
+    # Later definitions win, matching the SET semantics of repeated merges
+    namespaces = dict.fromkeys(namespace['name'] for namespace in graph_data['namespaces'])
+    namespaces.update(dict.fromkeys(cls['namespace'] for cls in graph_data['classes']))
+    classes = {
+        cls['name']: {"name": cls['name'], "filename": cls['filename'], "docstring": cls['docstring']}
+        for cls in graph_data['classes']
+    }
+    methods = {
+        method['name']: {"name": method['name'], "docstring": method['docstring'], "code": method['code']}
+        for method in graph_data['methods']
+    }
+    namespace_classes = dict.fromkeys((cls['namespace'], cls['name']) for cls in graph_data['classes'])
+    class_methods = dict.fromkeys((method['class'], method['name']) for method in graph_data['methods'])
 
-    tx.commit()
+    return {
+        'namespaces': [{"name": name} for name in namespaces],
+        'classes': list(classes.values()),
+        'methods': list(methods.values()),
+        'namespace_classes': [{"namespace": namespace, "class": cls} for namespace, cls in namespace_classes],
+        'class_methods': [{"class": cls, "method": method} for cls, method in class_methods]
+    }
+
+def merge_graph_data(tx, graph_data):
+    """Merge deduplicated nodes, then relationships, with one parameterized UNWIND query per batch."""
+    for query, rows in (
+        (MERGE_NAMESPACES_QUERY, graph_data['namespaces']),
+        (MERGE_CLASSES_QUERY, graph_data['classes']),
+        (MERGE_METHODS_QUERY, graph_data['methods']),
+        (MERGE_NAMESPACE_CLASSES_QUERY, graph_data['namespace_classes']),
+        (MERGE_CLASS_METHODS_QUERY, graph_data['class_methods'])
+    ):
+        for start in range(0, len(rows), NEO4J_BATCH_SIZE):
+            tx.run(query, rows=rows[start:start + NEO4J_BATCH_SIZE])
 
 def process_abstract_syntax_tree(file_path):
     builder = CSharpASTProcessor()
@@ -43,31 +121,94 @@ def process_abstract_syntax_tree(file_path):
     return graph_data
                         
 def vectorize_code_chunks(graph_data):
-    embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    vector_db = Chroma(persist_directory="./db", embedding_function=embedding_model)
+    embedding_model = OnnxMiniLMEmbeddings()
     
-    # Prepare method code for embedding
-    method_documents = []
+    # Methods are already meaningful units, so each one becomes a single chunk; only oversized methods
+    # are split, preferring blank lines, line breaks, braces and statement ends as split points
+    method_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=METHOD_CHUNK_SIZE,
+        chunk_overlap=METHOD_CHUNK_OVERLAP,
+        separators=["\n\n", "\n", "{", "}", ";"]
+    )
+    docs = []
     for method in graph_data['methods']:
-        method_code = method['code']
-        # Create proper Document objects instead of dictionaries
-        method_documents.append(
-            Document(
-                page_content=method_code,
-                metadata={"method_name": method['name'], "class_name": method['class']}
-            )
-        )
+        metadata = {
+            "method_name": method['name'],
+            "class_name": method['class'],
+            "qualname": qualname(method['class'], method['name'])
+        }
+        if len(method['code']) > MAX_METHOD_CHUNK_LENGTH:
+            docs.extend(method_splitter.create_documents([method['code']], metadatas=[metadata]))
+        else:
+            docs.append(Document(page_content=method['code'], metadata=metadata))
+    if not docs:
+        print("No method code chunks to ingest into ChromaDB.")
+        return
     
-    # Split method code into chunks for better embedding
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-    docs = text_splitter.split_documents(method_documents)
+    texts = [doc.page_content for doc in docs]
+    metadatas = [doc.metadata for doc in docs]
     
-    # Store method code in ChromaDB
-    vector_db = Chroma.from_documents(docs, embedding_model, persist_directory="./db")
-    vector_db.persist()
+    if CHROMA_HOST:
+        asyncio.run(stream_into_chroma_server(embedding_model, texts, metadatas))
+    else:
+        store_in_local_chroma(embedding_model, texts, metadatas)
 
     print(f"Ingested {len(docs)} method code chunks into ChromaDB.")
 
+def store_in_local_chroma(embedding_model, texts, metadatas):
+    """Embed all chunks and store them in the on-disk ChromaDB under ./db."""
+    # Embed all chunks in batches of similar token length
+    embeddings = embedding_model.encode(texts, batch_size=64)
+    
+    # Recreate the collection so re-ingesting does not duplicate chunks and the HNSW settings take effect
+    Chroma(persist_directory="./db", embedding_function=embedding_model).delete_collection()
+    vector_db = Chroma(
+        persist_directory="./db",
+        embedding_function=embedding_model,
+        collection_metadata=hnsw_collection_metadata(len(texts))
+    )
+    
+    # Store the precomputed embeddings in ChromaDB, in slices no larger than the client accepts per add
+    max_batch_size = vector_db._client.max_batch_size
+    for start in range(0, len(texts), max_batch_size):
+        end = start + max_batch_size
+        vector_db._collection.add(
+            ids=[str(uuid4()) for _ in texts[start:end]],
+            embeddings=embeddings[start:end].tolist(),
+            documents=texts[start:end],
+            metadatas=metadatas[start:end]
+        )
+    vector_db.persist()
+
+async def stream_into_chroma_server(embedding_model, texts, metadatas, batch_size=256):
+    """Embed chunks batch by batch and stream them to a Chroma server, inserting one batch while encoding the next."""
+    client = await chromadb.AsyncHttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    
+    # Recreate the collection so re-ingesting does not duplicate chunks and the HNSW settings take effect
+    collection_name = Chroma._LANGCHAIN_DEFAULT_COLLECTION_NAME
+    await client.get_or_create_collection(collection_name)
+    await client.delete_collection(collection_name)
+    collection = await client.create_collection(collection_name, metadata=hnsw_collection_metadata(len(texts)))
+    
+    loop = asyncio.get_running_loop()
+    pending_insert = None
+    for start in range(0, len(texts), batch_size):
+        batch_texts = texts[start:start + batch_size]
+        # Encode off the event loop so the previous batch's insert keeps progressing
+        embeddings = await loop.run_in_executor(None, embedding_model.encode, batch_texts)
+        
+        if pending_insert:
+            await pending_insert
+        pending_insert = asyncio.create_task(collection.add(
+            ids=[str(uuid4()) for _ in batch_texts],
+            embeddings=embeddings.tolist(),
+            documents=batch_texts,
+            metadatas=metadatas[start:start + batch_size]
+        ))
+    
+    if pending_insert:
+        await pending_insert
+
 def ingest_code(directory="./legacy_code"):
     """Scan C# code and insert relationships into Neo4j and ChromaDB."""
     graph_data = process_abstract_syntax_tree(directory)
@@ -73,15 +73,9 @@ DO NOT RETURN ANY EXPLANATIONS, MARKDOWN, OR COMMENTS.
 DO NOT INCLUDE ANY TEXT OTHER THAN THE CYPHER QUERY ITSELF.
 '''
 
-FINAL_RESPONSE_PROMPT = '''You are an expert C# developer with deep knowledge of functional programming patterns. Answer questions about legacy C# code based on the provided context.
-
-<graph_context>
-{graph_context}
-</graph_context>
-
-<vector_context>
-{vector_context}
-</vector_context>
+# The final prompt puts the static instructions and the question first and the retrieved context last,
+# so the preamble can be prefilled into Ollama's KV cache while retrieval is still running
+FINAL_RESPONSE_PREAMBLE = '''You are an expert C# developer with deep knowledge of functional programming patterns. Answer questions about legacy C# code based on the context provided after the question.
 
 CORE RESPONSIBILITIES:
 1. Explain C# code concepts, patterns, and implementation details
@@ -97,4 +91,16 @@ RESPONSE GUIDELINES:
 
 If the context seems insufficient, acknowledge limitations in your response.
 
-User question: {user_question}'''
\ No newline at end of file
+User question: {user_question}'''
+
+FINAL_RESPONSE_CONTEXT = '''
+
+<graph_context>
+{graph_context}
+</graph_context>
+
+<vector_context>
+{vector_context}
+</vector_context>'''
+
+FINAL_RESPONSE_PROMPT = FINAL_RESPONSE_PREAMBLE + FINAL_RESPONSE_CONTEXT
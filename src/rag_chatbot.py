@@ -1,16 +1,23 @@
+import asyncio
+import chromadb
+import hashlib
 import json
 import logging
 import ollama
 import os
+import threading
 from sys import stdout
-from neo4j import GraphDatabase
+from typing import List
+from cachetools import TTLCache
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from logging.handlers import RotatingFileHandler
 from langchain.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceEmbeddings
-from retrieval.vector_search import EnhancedVectorRetriever
+from langchain.schema import Document
+from embeddings.onnx_minilm import OnnxMiniLMEmbeddings
+from retrieval.vector_search import EnhancedVectorRetriever, build_faiss_index, qualname
 from retrieval.graph_search import GraphRetriever
-from prompting.HyDE import HYDE_SYSTEM_PROMPT, HYDE_REFINEMENT_PROMPT, FINAL_RESPONSE_PROMPT
+from prompting.HyDE import HYDE_SYSTEM_PROMPT, HYDE_REFINEMENT_PROMPT, FINAL_RESPONSE_PREAMBLE, FINAL_RESPONSE_PROMPT
 
 # Create log directory if it doesn't exist
 log_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".debug")
@@ -28,78 +35,151 @@ logging.basicConfig(
 )
 logger = logging.getLogger("rag_chatbot")
 
+# Graph results beyond this many characters are left out of the prompt rather than paid for in prefill
+MAX_GRAPH_CONTEXT_CHARS = 6000
+
+# Answers to recently asked questions, keyed by answer_cache_key; the lock guards it across worker threads
+answer_cache = TTLCache(maxsize=1024, ttl=3600)
+answer_cache_lock = threading.Lock()
+
+# How long Ollama keeps Mistral loaded after a request; reloading the weights takes seconds
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "1h")
+
+# One async client for all requests, so LLM calls don't block the event loop and reuse pooled HTTP connections
+ollama_client = ollama.AsyncClient()
+
 # Initialize FastAPI
 app = FastAPI()
 
-# Connect to Neo4j
-try:
-    driver = GraphDatabase.driver("bolt://localhost:7687", auth=("neo4j", "password"))
-    logger.info("Successfully connected to Neo4j")
-except Exception as e:
-    logger.error(f"Failed to connect to Neo4j: {e}")
-    driver = None
-
 # Load ChromaDB
+embedding_model = None
 try:
-    embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    vector_db = Chroma(persist_directory="./db", embedding_function=embedding_model)
+    embedding_model = OnnxMiniLMEmbeddings()
+    chroma_host = os.getenv("CHROMA_HOST")
+    if chroma_host:
+        chroma_client = chromadb.HttpClient(host=chroma_host, port=int(os.getenv("CHROMA_PORT", "8001")))
+        vector_db = Chroma(client=chroma_client, embedding_function=embedding_model)
+    else:
+        vector_db = Chroma(persist_directory="./db", embedding_function=embedding_model)
     logger.info("Successfully loaded ChromaDB")
 except Exception as e:
     logger.error(f"Failed to load ChromaDB: {e}")
     vector_db = None
 
 # Initialize retrievers
-graph_retriever = GraphRetriever(driver, HYDE_SYSTEM_PROMPT, HYDE_REFINEMENT_PROMPT)
+# Set CYPHER_SEMANTIC_CACHE_THRESHOLD (e.g. 0.9) to also reuse Cypher queries for similarly worded questions,
+# and CYPHER_CACHE_PATH to keep them across restarts
+semantic_cache_threshold = os.getenv("CYPHER_SEMANTIC_CACHE_THRESHOLD")
+graph_retriever_options = dict(
+    query_embeddings=embedding_model,
+    semantic_cache_threshold=float(semantic_cache_threshold) if semantic_cache_threshold else None,
+    cypher_cache_path=os.getenv("CYPHER_CACHE_PATH")
+)
+try:
+    # Concurrent requests each hold a pooled connection while their Cypher queries run
+    graph_retriever = GraphRetriever.build(
+        "bolt://localhost:7687",
+        ("neo4j", "password"),
+        HYDE_SYSTEM_PROMPT,
+        HYDE_REFINEMENT_PROMPT,
+        pool_size=int(os.getenv("NEO4J_MAX_CONNECTION_POOL_SIZE", "100")),
+        **graph_retriever_options
+    )
+    logger.info("Successfully connected to Neo4j")
+except Exception as e:
+    logger.error(f"Failed to connect to Neo4j: {e}")
+    graph_retriever = GraphRetriever(None, HYDE_SYSTEM_PROMPT, HYDE_REFINEMENT_PROMPT, **graph_retriever_options)
+
+# Set FAISS_UNFILTERED_SEARCH=1 to answer unfiltered vector searches from an in-memory FAISS copy of the collection
+faiss_index, faiss_documents = None, None
+if vector_db is not None and os.getenv("FAISS_UNFILTERED_SEARCH"):
+    try:
+        faiss_index, faiss_documents = build_faiss_index(vector_db)
+        logger.info(f"Built FAISS index of {faiss_index.ntotal} chunks")
+    except Exception as e:
+        logger.error(f"Failed to build FAISS index: {e}")
+vector_retriever = EnhancedVectorRetriever(vector_db, faiss_index, faiss_documents)
+
+@app.on_event("startup")
+async def warm_up():
+    """Load Mistral into Ollama and touch the Chroma index so the first query doesn't pay for either."""
+    try:
+        # An empty prompt only loads the model
+        await ollama_client.generate(model="mistral", prompt="", keep_alive=OLLAMA_KEEP_ALIVE)
+        logger.info("Loaded Mistral in Ollama")
+    except Exception as e:
+        logger.warning(f"Failed to preload Mistral: {e}")
+
+    if vector_db is not None:
+        try:
+            await asyncio.to_thread(vector_retriever.warmup)
+            logger.info("Loaded ChromaDB index")
+        except Exception as e:
+            logger.warning(f"Failed to preload ChromaDB index: {e}")
 
 @app.get("/query/")
-async def query_llm(user_question: str, use_refinement: bool = True):
-    """Retrieve related methods/classes & vector search snippets."""
+async def query_llm(user_question: str, use_refinement: bool = True, stream: bool = True):
+    """Retrieve related methods/classes & vector search snippets, then stream (or return) the LLM answer."""
     try:
         logger.info(f"Received query endpoint request: {user_question}")
         
-        # Stage 1: Get structured data from Neo4j using two-stage HyDE
-        neo4j_results = graph_retriever.fetch_related_code(user_question, use_refinement=use_refinement)
+        # Repeated questions are answered from the cache without retrieval or generation
+        cache_key = answer_cache_key(user_question, use_refinement)
+        with answer_cache_lock:
+            cached_answer = answer_cache.get(cache_key)
+        if cached_answer is not None:
+            logger.info("Returning cached answer")
+            return PlainTextResponse(cached_answer) if stream else {"answer": cached_answer}
+        
+        # Prefill the static part of the final prompt while retrieval runs; Ollama reuses the cached prefix
+        prefill_task = asyncio.create_task(prefill_prompt(FINAL_RESPONSE_PREAMBLE.format(user_question=user_question)))
+        
+        # Stage 1: Get structured data from Neo4j using two-stage HyDE, and meanwhile run a
+        # vector search on the question alone
+        neo4j_results, (vector_results, enhanced_query) = await asyncio.gather(
+            graph_retriever.afetch_related_code(user_question, use_refinement=use_refinement),
+            vector_retriever.aretrieve(user_question, k=10)
+        )
         logger.debug(f"Neo4j results: {json.dumps(neo4j_results, default=str)[:500]}...")
         
-        # Process Neo4j results and prepare for ChromaDB
-        method_names = []
-        class_names = []
-        method_docstrings = []  # New list to store method docstrings
-        graph_context_items = []
+        # Process Neo4j results and prepare for ChromaDB; rows repeat names (one row per method of a class),
+        # so keep each name once, in result order, to keep the Chroma filters and the enriched query small
+        method_names = list(dict.fromkeys(item["Method"] for item in neo4j_results if item.get("Method")))
+        class_names = list(dict.fromkeys(item["Class"] for item in neo4j_results if item.get("Class")))
+        method_docstrings = list(dict.fromkeys(
+            item["Documentation"] for item in neo4j_results if "Method" in item and item.get("Documentation")
+        ))
+        # The Class::Method pair of each row, never a cross product of the names, marks the chunks to rank first
+        qualnames = list(dict.fromkeys(
+            qualname(item["Class"], item["Method"])
+            for item in neo4j_results if item.get("Class") and item.get("Method")
+        ))
         
-        # Limit the number of items from Neo4j results to control token size
-        for item in neo4j_results:
-            if "Method" in item:
-                method_names.append(item["Method"])
-                if "Documentation" in item:
-                    method_docstrings.append(item["Documentation"])
-            if "Class" in item:
-                class_names.append(item["Class"])
-
-            # Create a human-readable summary of each result
-            item_summary = []
-            for key, value in item.items():
-                if value and isinstance(value, str):  # Check if value exists and is a string
-                    item_summary.append(f"{key}: {value}")
-            
-            if item_summary:
-                graph_context_items.append("\n".join(set(item_summary)))  # Use set to avoid duplicates
+        # Create a human-readable summary of each result; dict.fromkeys drops repeated rows and keeps their order
+        graph_context_items = [
+            summary for summary in dict.fromkeys(
+                "\n".join(f"{key}: {value}" for key, value in item.items() if value and isinstance(value, str))
+                for item in neo4j_results
+            )
+            if summary
+        ]
         
-        # Join all text summaries
-        graph_context = "\n\n".join(graph_context_items)
+        # Join the text summaries, cutting the one that overflows the token budget short
+        graph_context = join_within_budget(graph_context_items, "\n\n", MAX_GRAPH_CONTEXT_CHARS)
         logger.debug(f"Graph context length: {len(graph_context)} characters")
         
-        # Stage 2: Use the EnhancedVectorRetriever for vector search
-        vector_retriever = EnhancedVectorRetriever(vector_db)
-        
-        # Perform the retrieval with semantic enrichment and metadata filtering
-        vector_results, enhanced_query = vector_retriever.retrieve(
-            user_question,
-            method_names,
-            class_names,
-            method_docstrings,
-            k=10
-        )
+        # Stage 2: If Neo4j found methods/classes, run a second vector pass with semantic enrichment
+        # and metadata filtering, and rank its results ahead of those of the question-only pass
+        if method_names or class_names:
+            filtered_results, enhanced_query = await vector_retriever.aretrieve(
+                user_question,
+                method_names,
+                class_names,
+                method_docstrings,
+                k=10,
+                qualnames=qualnames
+            )
+            vector_results = merge_vector_results(filtered_results, vector_results, k=10)
         
         # Format the results for the final prompt
         vector_context = vector_retriever.format_results(vector_results)
@@ -121,19 +201,96 @@ async def query_llm(user_question: str, use_refinement: bool = True):
             # Fallback to f-string if format fails
             prompt = f"{FINAL_RESPONSE_PROMPT}\n\nGraph Context:\n{graph_context}\n\nVector Context:\n{vector_context}\n\nUser Question: {user_question}"
         
-        # Get response from LLM
+        # Get response from LLM once the preamble is in the KV cache
+        await prefill_task
         logger.info("Requesting final response from Mistral")
-        response = ollama.chat(model="mistral", messages=[{"role": "user", "content": prompt}])
+        if stream:
+            # Send tokens to the client as Mistral generates them
+            return StreamingResponse(stream_answer(prompt, cache_key), media_type="text/plain; charset=utf-8")
+
+        response = await ollama_client.chat(model="mistral", messages=[{"role": "user", "content": prompt}], keep_alive=OLLAMA_KEEP_ALIVE)
         result = {"answer": response["message"]["content"]}
+        with answer_cache_lock:
+            answer_cache[cache_key] = result["answer"]
 
         logger.info("Successfully generated response")
+        logger.debug(f"Final prompt evaluated {response.get('prompt_eval_count', 0)} uncached tokens")
         logger.debug(f"Response length: {len(result['answer'])} characters")
         
         return result
     
     except Exception as e:
         logger.error(f"Error in query_llm: {e}", exc_info=True)
-        return {"answer": f"An error occurred: {str(e)}. Please check the logs for more details."}
+        error_message = f"An error occurred: {str(e)}. Please check the logs for more details."
+        if stream:
+            return PlainTextResponse(error_message, status_code=500)
+        return {"answer": error_message}
+
+def answer_cache_key(user_question: str, use_refinement: bool) -> str:
+    """Hash the question with case and whitespace normalized, together with the options that change the answer."""
+    normalized_question = " ".join(user_question.lower().split())
+    return hashlib.sha1(f"{use_refinement}\0{normalized_question}".encode("utf-8")).hexdigest()
+
+def join_within_budget(items: List[str], separator: str, max_chars: int) -> str:
+    """
+    Join the leading items within max_chars, separators included.
+    
+    The item that overflows the budget is cut to the room left rather than dropped, so a single oversized
+    summary still fills the context instead of emptying it.
+    """
+    length = -len(separator)
+    for count, item in enumerate(items):
+        length += len(separator) + len(item)
+        if length > max_chars:
+            logger.debug(f"Context budget of {max_chars} characters reached - truncating item {count + 1} of {len(items)}")
+            room = len(item) - (length - max_chars)
+            return separator.join(items[:count] + [item[:room]] if room > 0 else items[:count])
+    return separator.join(items)
+
+def merge_vector_results(primary: List[Document], secondary: List[Document], k: int) -> List[Document]:
+    """Combine two vector result lists, keeping the first occurrence of each chunk, up to k results."""
+    merged = {}
+    for doc in primary + secondary:
+        key = (doc.page_content, doc.metadata.get("method_name"), doc.metadata.get("class_name"))
+        merged.setdefault(key, doc)
+    return list(merged.values())[:k]
+
+async def prefill_prompt(preamble: str):
+    """Evaluate the prompt preamble in Mistral so the final request only has to prefill the context."""
+    try:
+        # Generate a single token: the point is the prompt evaluation, which leaves the prefix in the KV cache
+        response = await ollama_client.generate(model="mistral", prompt=preamble, keep_alive=OLLAMA_KEEP_ALIVE, options={"num_predict": 1})
+        logger.debug(f"Prefilled {response.get('prompt_eval_count', 0)} preamble tokens")
+    except Exception as e:
+        # Only an optimization - the final request still works without the warm cache
+        logger.warning(f"Failed to prefill prompt preamble: {e}")
+
+async def stream_answer(prompt: str, cache_key: str):
+    """Yield the final answer chunk by chunk as Mistral generates it, and cache it once complete."""
+    answer_parts = []
+    answer_length = 0
+    try:
+        response_stream = await ollama_client.chat(model="mistral", messages=[{"role": "user", "content": prompt}], stream=True, keep_alive=OLLAMA_KEEP_ALIVE)
+        async for chunk in response_stream:
+            content = chunk["message"]["content"]
+            answer_parts.append(content)
+            answer_length += len(content)
+            yield content
+
+            # The final chunk carries the timing stats
+            if chunk.get("done"):
+                logger.debug(f"Final prompt evaluated {chunk.get('prompt_eval_count', 0)} uncached tokens")
+
+        with answer_cache_lock:
+            answer_cache[cache_key] = "".join(answer_parts)
+
+        logger.info("Successfully streamed response")
+        logger.debug(f"Response length: {answer_length} characters")
+
+    except Exception as e:
+        # Headers are already sent, so report the failure in the body
+        logger.error(f"Error while streaming response: {e}", exc_info=True)
+        yield f"\n\nAn error occurred: {str(e)}. Please check the logs for more details."
 
 # For direct testing
 if __name__ == "__main__":
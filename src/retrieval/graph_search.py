@@ -1,15 +1,135 @@
+import asyncio
+import hashlib
 import logging
 import ollama
 import json
-from neo4j import GraphDatabase
-from typing import List, Dict, Any, Optional
+import re
+import sqlite3
+import threading
+import time
+import weakref
+import numpy as np
+from cachetools import TLRUCache
+from contextlib import closing
+from langchain.embeddings.base import Embeddings
+from neo4j import GraphDatabase, Result, RoutingControl
+from typing import List, Dict, Any, Optional, Set, Tuple
 
 logger = logging.getLogger("rag_chatbot.graph_search")
 
+# Naming the database saves the driver a round-trip to resolve the user's home database
+NEO4J_DATABASE = "neo4j"
+
+# Text indexes on the lowercased method name and docstring, created by ingest.py, that the fallback query can use
+FALLBACK_TEXT_INDEXES = {("Method", "name_lower"), ("Method", "docstring_lower")}
+
+# A Cypher query with its parameters; LLM-generated queries have none
+CypherQuery = Tuple[str, Dict[str, Any]]
+
+# Keyword search used when no usable query is generated. The term is passed as $term, so the text is
+# constant and Neo4j plans it once. With the lowercased copies text-indexed (see ingest.py), the filter
+# is answered from the indexes instead of lowercasing every method's name and docstring
+FALLBACK_QUERY = """
+        MATCH (m:Method)
+        WHERE toLower(m.name) CONTAINS toLower($term) OR toLower(m.docstring) CONTAINS toLower($term)
+        MATCH (c:Class)-[:CONTAINS]->(m)
+        MATCH (n:Namespace)-[:CONTAINS]->(c)
+        RETURN n.name AS Namespace, c.name AS Class, m.name AS Method
+        LIMIT $k
+        """
+
+FALLBACK_QUERY_TEXT_INDEXED = """
+        MATCH (m:Method)
+        USING TEXT INDEX m:Method(name_lower)
+        USING TEXT INDEX m:Method(docstring_lower)
+        WHERE m.name_lower CONTAINS toLower($term) OR m.docstring_lower CONTAINS toLower($term)
+        MATCH (c:Class)-[:CONTAINS]->(m)
+        MATCH (n:Namespace)-[:CONTAINS]->(c)
+        RETURN n.name AS Namespace, c.name AS Class, m.name AS Method
+        LIMIT $k
+        """
+
+# Default number of rows fetched per question; LIMITs in generated queries are clamped to it, so Neo4j stops
+# matching early and less is sent back over bolt
+DEFAULT_TOP_K = 50
+
+# Share of the question's words that must appear in the first results for them to be kept unrefined
+REFINEMENT_OVERLAP_THRESHOLD = 0.3
+
+# Longest string value shown in the sample results of the refinement prompt
+SAMPLE_VALUE_MAX_CHARS = 120
+
+# Questions per batched Codestral call; more makes the answer long enough that queries start getting dropped
+CYPHER_BATCH_SIZE = 5
+
+# A usable query needs MATCH, RETURN and LIMIT (in any order, any case); anchored, so each lookahead runs once
+_REQUIRED_RE = re.compile(r'(?=.*\bMATCH\b)(?=.*\bRETURN\b)(?=.*\bLIMIT\b)', re.IGNORECASE | re.DOTALL)
+
+# Properties the LLM tends to invent that don't exist in the graph schema
+_BAD_PROP_RE = re.compile(r'\.(description|comments|content|body|type)\b')
+
+# A question that is just one C# identifier
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]{2,}')
+
+def _is_identifier_query(user_query: str) -> bool:
+    """Whether a question is a bare identifier, answered by the fallback keyword search without Codestral."""
+    return _IDENTIFIER_RE.fullmatch(user_query.strip()) is not None
+
+# String operators that call for case-insensitive matching; searched for without uppercasing a copy of the query
+_STRING_OPERATOR_RE = re.compile(r'\b(?:CONTAINS|STARTS\s+WITH)\b', re.IGNORECASE)
+
+# String comparisons in WHERE clauses: property CONTAINS / STARTS WITH a quoted literal
+_STRING_COMPARISON_RE = re.compile(
+    r'((?:WHERE|OR)\s+)(\w+\.\w+)\s+(CONTAINS|STARTS\s+WITH)\s+(["\'])(.+?)(["\'])', re.IGNORECASE
+)
+
+def _case_insensitive_comparison(match: re.Match) -> str:
+    """Rewrite a matched string comparison to compare both sides lowercased."""
+    prefix, prop, operator, open_quote, value, close_quote = match.groups()
+    operator = "CONTAINS" if operator.upper() == "CONTAINS" else "STARTS WITH"
+    return f"{prefix}toLower({prop}) {operator} toLower({open_quote}{value}{close_quote})"
+
+# A "[n]" marker followed by a fenced Cypher block, as requested by the batch prompt
+_BATCH_CYPHER_RE = re.compile(r'\[(\d+)\][^`]*?```(?:cypher)?\s*(.*?)```', re.DOTALL | re.IGNORECASE)
+
+# Persistent copy of the Cypher cache, so a restarted process starts warm; embedding holds the float32 bytes
+# of the question embedding when the semantic layer is on, and prompt_digest identifies the HyDE system prompt
+# that generated the query, so rows of other prompts are never loaded
+CYPHER_CACHE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cypher_cache (
+            cache_key TEXT PRIMARY KEY,
+            prompt_digest TEXT NOT NULL,
+            embedding BLOB,
+            cypher TEXT NOT NULL,
+            params TEXT NOT NULL,
+            ts REAL NOT NULL
+        )
+        """
+
+# Literal LIMIT clauses, clamped to the caller's top_k before a query runs
+_LIMIT_RE = re.compile(r'\bLIMIT\s+(\d+)', re.IGNORECASE)
+
+def _clamp_limit(cypher_query: CypherQuery, top_k: int) -> CypherQuery:
+    """Lower every literal LIMIT of a query to at most top_k, and bind $k to top_k."""
+    cypher, params = cypher_query
+    cypher = _LIMIT_RE.sub(lambda match: f"LIMIT {min(int(match.group(1)), top_k)}", cypher)
+    return cypher, {**params, "k": top_k}
+
+# The first fenced code block of an LLM answer, without its optional "cypher" language tag
+_FENCE_RE = re.compile(r'```(?:cypher)?\s*\n?(.*?)```', re.DOTALL | re.IGNORECASE)
+
+def _extract_cypher(text: str) -> str:
+    """Return the contents of the first fenced code block in text, or the whole text if it has none."""
+    match = _FENCE_RE.search(text)
+    return match.group(1).strip() if match else text.strip()
+
 class GraphRetriever:
     """A class for retrieving code information from Neo4j using HyDE approach."""
     
-    def __init__(self, driver: GraphDatabase.driver, hyde_system_prompt: str, hyde_refinement_prompt: str = None):
+    def __init__(self, driver: GraphDatabase.driver, hyde_system_prompt: str, hyde_refinement_prompt: str = None,
+                 cypher_cache_size: int = 1024, cypher_cache_ttl: float = 3600,
+                 query_embeddings: Optional[Embeddings] = None, semantic_cache_threshold: Optional[float] = None,
+                 cypher_cache_path: Optional[str] = None):
         """
         Initialize the GraphRetriever.
         
@@ -17,18 +137,195 @@ class GraphRetriever:
             driver: Neo4j database driver
             hyde_system_prompt: System prompt for HyDE query generation
             hyde_refinement_prompt: System prompt for refining queries based on initial results
+            cypher_cache_size: Number of generated Cypher queries to keep
+            cypher_cache_ttl: Seconds a generated Cypher query is reused for
+            query_embeddings: Embeddings used to match a question against the cached questions
+            semantic_cache_threshold: Cosine similarity above which the Cypher query of a cached question is reused
+                for a differently worded one; None only reuses queries for the same question
+            cypher_cache_path: SQLite file the Cypher cache is persisted to and loaded from; None keeps it in memory
         """
         self.driver = driver
         self.hyde_system_prompt = hyde_system_prompt
         self.hyde_refinement_prompt = hyde_refinement_prompt
         
-    def fetch_related_code(self, user_query: str, use_refinement: bool = True) -> List[Dict[str, Any]]:
+        # Cypher generation by Codestral is the slowest step, so reuse the query for repeated questions.
+        # Keys cover the system prompt as well, so changing the prompt never serves queries it didn't produce.
+        # Entries expire cypher_cache_ttl seconds after they were generated (wall clock, so persisted entries
+        # loaded at startup keep their original expiry, see _load_persisted_cypher_cache)
+        self.cypher_cache_ttl = cypher_cache_ttl
+        self._loaded_expiry: Dict[str, float] = {}
+        self._cypher_cache = TLRUCache(maxsize=cypher_cache_size, ttu=self._cypher_cache_expiry, timer=time.time)
+        self._cypher_cache_lock = threading.Lock()
+        self._cache_key_prefix = hashlib.blake2b(hyde_system_prompt.encode("utf-8")).digest()
+        
+        # Semantic layer: normalized question embeddings, row i belonging to the cache entry _semantic_keys[i]
+        self.query_embeddings = query_embeddings
+        self.semantic_cache_threshold = semantic_cache_threshold
+        self._semantic_keys: List[str] = []
+        self._semantic_vectors: Optional[np.ndarray] = None
+        
+        self.cypher_cache_path = cypher_cache_path
+        if cypher_cache_path:
+            self._load_persisted_cypher_cache()
+        
+        # (label, property) pairs with a text index, used to add index hints to the fallback query
+        self._text_indexed_properties = self._load_text_indexed_properties()
+        
+        # Async Ollama clients per event loop, since their pooled connections are bound to the loop that opened them
+        self._aclients = weakref.WeakKeyDictionary()
+    
+    @classmethod
+    def build(cls, uri: str, auth: Tuple[str, str], hyde_system_prompt: str, hyde_refinement_prompt: str = None, *,
+              pool_size: int = 100, connection_acquisition_timeout: float = 5.0, connection_timeout: float = 5.0,
+              max_transaction_retry_time: float = 10.0, **retriever_kwargs) -> "GraphRetriever":
+        """
+        Connect to Neo4j with pool settings suited to bursts of concurrent queries and create a GraphRetriever.
+        
+        Args:
+            uri: Neo4j bolt URI
+            auth: (user, password) pair
+            hyde_system_prompt: System prompt for HyDE query generation
+            hyde_refinement_prompt: System prompt for refining queries based on initial results
+            pool_size: Maximum number of pooled connections
+            connection_acquisition_timeout: Seconds a query waits for a pooled connection before failing, so a
+                saturated pool surfaces as an error instead of a stalled request
+            connection_timeout: Seconds to wait when opening a new connection
+            max_transaction_retry_time: Seconds transient failures are retried for
+            **retriever_kwargs: Further GraphRetriever arguments
+            
+        Returns:
+            GraphRetriever using the new driver
+        """
+        driver = GraphDatabase.driver(
+            uri,
+            auth=auth,
+            max_connection_pool_size=pool_size,
+            connection_acquisition_timeout=connection_acquisition_timeout,
+            connection_timeout=connection_timeout,
+            max_transaction_retry_time=max_transaction_retry_time,
+            # TCP keep-alive, so idle pooled connections aren't silently dropped between bursts
+            keep_alive=True
+        )
+        return cls(driver, hyde_system_prompt, hyde_refinement_prompt, **retriever_kwargs)
+    
+    def _cypher_cache_expiry(self, cache_key: str, cypher_query: CypherQuery, now: float) -> float:
+        """Expiry time of a cache entry: a full TTL from now, or the original expiry of a persisted entry."""
+        return self._loaded_expiry.pop(cache_key, now + self.cypher_cache_ttl)
+    
+    def _load_persisted_cypher_cache(self) -> None:
+        """Purge expired rows from the persistent Cypher cache and load this prompt's rows into memory."""
+        try:
+            with closing(sqlite3.connect(self.cypher_cache_path)) as conn, conn:
+                # WAL lets other workers read the cache while one of them writes to it
+                conn.execute("PRAGMA journal_mode=WAL")
+                # Files written before rows recorded their prompt can't be trusted for any prompt
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(cypher_cache)")}
+                if columns and "prompt_digest" not in columns:
+                    conn.execute("DROP TABLE cypher_cache")
+                conn.execute(CYPHER_CACHE_SCHEMA)
+                conn.execute("DELETE FROM cypher_cache WHERE ts < ?", (time.time() - self.cypher_cache_ttl,))
+                rows = conn.execute(
+                    "SELECT cache_key, embedding, cypher, params, ts FROM cypher_cache WHERE prompt_digest = ? "
+                    "ORDER BY ts DESC LIMIT ?",
+                    (self._cache_key_prefix.hex(), int(self._cypher_cache.maxsize))
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not load the persistent Cypher cache: {e}")
+            self.cypher_cache_path = None
+            return
+        
+        # Oldest first, so the cache evicts in the same order it would have. Only embeddings as wide as the
+        # newest one are indexed; older widths come from a previous embedding model
+        width = next((len(embedding) for _, embedding, _, _, _ in rows if embedding is not None), None)
+        semantic_keys, semantic_vectors = [], []
+        for cache_key, embedding, cypher, params, ts in reversed(rows):
+            self._loaded_expiry[cache_key] = ts + self.cypher_cache_ttl
+            self._cypher_cache[cache_key] = (cypher, json.loads(params))
+            if embedding is not None and len(embedding) == width:
+                semantic_keys.append(cache_key)
+                semantic_vectors.append(np.frombuffer(embedding, dtype=np.float32))
+        if semantic_vectors:
+            self._semantic_keys = semantic_keys
+            self._semantic_vectors = np.vstack(semantic_vectors)
+        logger.info(f"Loaded {len(rows)} persisted Cypher queries")
+    
+    def _load_text_indexed_properties(self) -> Set[Tuple[str, str]]:
+        """Look up which node properties have an online text index."""
+        if self.driver is None:
+            return set()
+        try:
+            records = self._run_read_query(
+                "SHOW TEXT INDEXES YIELD labelsOrTypes, properties, state WHERE state = 'ONLINE' "
+                "RETURN labelsOrTypes, properties"
+            )
+        except Exception as e:
+            logger.warning(f"Could not list Neo4j text indexes: {e}")
+            return set()
+        return {
+            (label, prop)
+            for record in records
+            for label in record["labelsOrTypes"] or []
+            for prop in record["properties"] or []
+        }
+    
+    @property
+    def aclient(self) -> ollama.AsyncClient:
+        """The async Ollama client for the running event loop."""
+        loop = asyncio.get_running_loop()
+        client = self._aclients.get(loop)
+        if client is None:
+            client = self._aclients[loop] = ollama.AsyncClient()
+        return client
+        
+    def fetch_related_code(self, user_query: str, use_refinement: bool = True,
+                           top_k: int = DEFAULT_TOP_K) -> List[Dict[str, Any]]:
+        """
+        Query Neo4j for methods/classes related to the user query using HyDE approach.
+        
+        Blocking wrapper around afetch_related_code for callers without a running event loop.
+        
+        Args:
+            user_query: User's natural language question
+            use_refinement: Whether to use query refinement (two-stage approach)
+            top_k: Maximum number of results to fetch
+            
+        Returns:
+            List of dictionaries containing Neo4j query results
+        """
+        return asyncio.run(self.afetch_related_code(user_query, use_refinement=use_refinement, top_k=top_k))
+    
+    async def afetch_related_code_batch(self, user_queries: List[str], use_refinement: bool = True,
+                                        top_k: int = DEFAULT_TOP_K) -> List[List[Dict[str, Any]]]:
+        """
+        Fetch related code for several questions concurrently.
+        
+        Args:
+            user_queries: User questions
+            use_refinement: Whether to use query refinement (two-stage approach)
+            top_k: Maximum number of results to fetch per question
+            
+        Returns:
+            List of Neo4j results per question, in the order of user_queries
+        """
+        # The initial Cypher queries of uncached questions are generated a few per Codestral call;
+        # refinements are per question and overlap up to the Ollama server's OLLAMA_NUM_PARALLEL
+        initial_queries = await self._get_cypher_queries(user_queries)
+        return await asyncio.gather(*[
+            self._fetch_with_cypher_query(user_query, initial_query, use_refinement, top_k)
+            for user_query, initial_query in zip(user_queries, initial_queries)
+        ])
+    
+    async def afetch_related_code(self, user_query: str, use_refinement: bool = True,
+                                  top_k: int = DEFAULT_TOP_K) -> List[Dict[str, Any]]:
         """
         Query Neo4j for methods/classes related to the user query using HyDE approach.
         
+        Codestral is called asynchronously; the blocking Neo4j queries run in worker threads.
+        
         Args:
             user_query: User's natural language question
             use_refinement: Whether to use query refinement (two-stage approach)
+            top_k: Maximum number of results to fetch
             
         Returns:
             List of dictionaries containing Neo4j query results
@@ -38,45 +335,182 @@ class GraphRetriever:
             logger.info(f"Processing query: {user_query}")
             
             # First stage: Generate initial Cypher query using HyDE approach
-            initial_query = self._generate_cypher_query(user_query)
-            
-            if not initial_query:
-                logger.error("Failed to generate a valid Cypher query")
-                return []
-            
-            # Execute the initial Cypher query
-            initial_results = self._execute_cypher_query(initial_query)
+            initial_query = await self._get_cypher_query(user_query)
+            return await self._fetch_with_cypher_query(user_query, initial_query, use_refinement, top_k)
             
-            # If refinement is enabled and we have a refinement prompt
-            if use_refinement and self.hyde_refinement_prompt and initial_query:
+        except Exception as e:
+            logger.error(f"Error in afetch_related_code: {e}", exc_info=True)
+            return []
+    
+    async def _fetch_with_cypher_query(self, user_query: str, initial_query: Optional[CypherQuery],
+                                       use_refinement: bool, top_k: int = DEFAULT_TOP_K) -> List[Dict[str, Any]]:
+        """Run the initial Cypher query for a question, then refine it if the results look off."""
+        if not initial_query:
+            logger.error("Failed to generate a valid Cypher query")
+            return []
+        
+        try:
+            # Execute the initial Cypher query, fetching no more rows than the caller needs
+            initial_query = _clamp_limit(initial_query, top_k)
+            # Keyword search for this question, run instead of a query that fails in Neo4j
+            fallback_query = _clamp_limit(self._generate_fallback_query(user_query), top_k)
+            initial_results = await asyncio.to_thread(self._execute_cypher_query, *initial_query, fallback_query)
+        
+            # If refinement is enabled and we have a refinement prompt; an identifier's keyword search is final,
+            # as refining it would bring back the Codestral call the lookup skipped
+            if use_refinement and self.hyde_refinement_prompt and initial_query and not _is_identifier_query(user_query):
                 # Check if refinement is needed based on results
                 if self._should_refine_query(initial_results, user_query):
                     # Generate a refined query
-                    refined_query = self._refine_cypher_query(
+                    refined_query = await self._refine_cypher_query(
                         user_query, 
                         initial_query, 
                         initial_results
                     )
-                    
+                
                     if refined_query and refined_query != initial_query:
-                        logger.info(f"Using refined query: {refined_query}")
+                        logger.info(f"Using refined query: {refined_query[0]}")
                         # Execute the refined query
-                        refined_results = self._execute_cypher_query(refined_query)
-                        
+                        refined_results = await asyncio.to_thread(self._execute_cypher_query,
+                                                                  *_clamp_limit(refined_query, top_k), fallback_query)
+                    
                         # If refined query returned results, use those instead
                         if refined_results:
                             logger.info(f"Refined query returned {len(refined_results)} results")
                             return refined_results
-                
+            
                 # Return initial results if refinement didn't happen or didn't help
                 return initial_results
             else:
                 # Return initial results if refinement is disabled
                 return initial_results
-            
+        
         except Exception as e:
-            logger.error(f"Error in fetch_related_code: {e}", exc_info=True)
+            logger.error(f"Error in _fetch_with_cypher_query: {e}", exc_info=True)
             return []
+
+    async def _get_cypher_query(self, user_query: str) -> Optional[CypherQuery]:
+        """Return the cached Cypher query for a question, or for a close enough one, generating it on a miss."""
+        cypher_query, cache_key, query_vector = await self._lookup_cypher_query(user_query)
+        if cypher_query is not None:
+            return cypher_query
+        
+        cypher_query, generated = await self._generate_cypher_query(user_query)
+        # Don't cache the fallback used when Codestral could not be reached
+        if cypher_query and generated:
+            await self._store_cypher_query(cache_key, cypher_query, query_vector)
+        return cypher_query
+    
+    async def _get_cypher_queries(self, user_queries: List[str]) -> List[Optional[CypherQuery]]:
+        """Like _get_cypher_query for several questions, generating the uncached ones in batched Codestral calls."""
+        lookups = await asyncio.gather(*[self._lookup_cypher_query(user_query) for user_query in user_queries])
+        cypher_queries = [cypher_query for cypher_query, _, _ in lookups]
+        
+        misses = [i for i, cypher_query in enumerate(cypher_queries) if cypher_query is None]
+        batches = [misses[start:start + CYPHER_BATCH_SIZE] for start in range(0, len(misses), CYPHER_BATCH_SIZE)]
+        batch_results = await asyncio.gather(*[
+            self._generate_cypher_queries_batch([user_queries[i] for i in batch]) for batch in batches
+        ])
+        
+        stores = []
+        for batch, results in zip(batches, batch_results):
+            for i, (cypher_query, generated) in zip(batch, results):
+                cypher_queries[i] = cypher_query
+                if cypher_query and generated:
+                    _, cache_key, query_vector = lookups[i]
+                    stores.append(self._store_cypher_query(cache_key, cypher_query, query_vector))
+        await asyncio.gather(*stores)
+        return cypher_queries
+    
+    async def _lookup_cypher_query(self, user_query: str) -> Tuple[Optional[CypherQuery], str, Optional[np.ndarray]]:
+        """
+        Look a question up in the Cypher cache.
+        
+        Args:
+            user_query: User's natural language question
+            
+        Returns:
+            Tuple containing (cached Cypher query or None, cache key, question embedding if the semantic layer is on);
+            identifier-only questions get the fallback query instead of a cache lookup
+        """
+        # A bare identifier ("OptionExtensions") needs no Codestral call: the fallback query searches for exactly it
+        if _is_identifier_query(user_query):
+            logger.info("Query is a single identifier - using fallback query without Codestral")
+            return self._generate_fallback_query(user_query.strip()), "", None
+        
+        normalized_query = " ".join(user_query.lower().split())
+        cache_key = hashlib.blake2b(self._cache_key_prefix + normalized_query.encode("utf-8")).hexdigest()
+        with self._cypher_cache_lock:
+            cypher_query = self._cypher_cache.get(cache_key)
+        if cypher_query is not None:
+            logger.info(f"Using cached Cypher query: {cypher_query[0]}")
+            return cypher_query, cache_key, None
+        
+        query_vector = None
+        if self.query_embeddings is not None and self.semantic_cache_threshold is not None:
+            query_vector = await asyncio.to_thread(self._embed_for_semantic_cache, normalized_query)
+            cypher_query = self._find_similar_cached_query(query_vector)
+            if cypher_query is not None:
+                logger.info(f"Using Cypher query cached for a similar question: {cypher_query[0]}")
+        return cypher_query, cache_key, query_vector
+    
+    def _embed_for_semantic_cache(self, normalized_query: str) -> np.ndarray:
+        """Embed a question as a unit vector, so a dot product gives the cosine similarity."""
+        vector = np.asarray(self.query_embeddings.embed_query(normalized_query), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+    
+    def _find_similar_cached_query(self, query_vector: np.ndarray) -> Optional[CypherQuery]:
+        """Return the Cypher query of the most similar cached question if it clears the threshold."""
+        with self._cypher_cache_lock:
+            # Vectors of another width were made by a different embedding model and can't be compared
+            if not self._semantic_keys or self._semantic_vectors.shape[1] != query_vector.shape[0]:
+                return None
+            # One matrix-vector product scores the question against every cached question
+            similarities = self._semantic_vectors @ query_vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.semantic_cache_threshold:
+                return None
+            # None if the entry has expired since it was indexed
+            return self._cypher_cache.get(self._semantic_keys[best])
+    
+    async def _store_cypher_query(self, cache_key: str, cypher_query: CypherQuery,
+                                  query_vector: Optional[np.ndarray]) -> None:
+        """Cache a generated Cypher query in memory and write it through to the persistent cache, if there is one."""
+        self._cache_cypher_query(cache_key, cypher_query, query_vector)
+        # sqlite blocks, so the write-through runs in a worker thread instead of on the event loop
+        if self.cypher_cache_path:
+            await asyncio.to_thread(self._persist_cypher_query, cache_key, cypher_query, query_vector)
+    
+    def _cache_cypher_query(self, cache_key: str, cypher_query: CypherQuery, query_vector: Optional[np.ndarray]) -> None:
+        """Put a Cypher query in the in-memory cache and its question vector in the semantic index."""
+        with self._cypher_cache_lock:
+            self._cypher_cache[cache_key] = cypher_query
+            if query_vector is None:
+                return
+            
+            # Drop the vectors of entries that were evicted or expired, then add the new one
+            live = [i for i, key in enumerate(self._semantic_keys) if key in self._cypher_cache and key != cache_key]
+            self._semantic_keys = [self._semantic_keys[i] for i in live] + [cache_key]
+            if self._semantic_vectors is None or self._semantic_vectors.shape[1] != query_vector.shape[0]:
+                # First vector, or the first one of a new embedding model, whose predecessors can't be compared
+                self._semantic_keys = [cache_key]
+                self._semantic_vectors = query_vector[None, :]
+            else:
+                self._semantic_vectors = np.vstack([self._semantic_vectors[live], query_vector])
+    
+    def _persist_cypher_query(self, cache_key: str, cypher_query: CypherQuery, query_vector: Optional[np.ndarray]) -> None:
+        """Write a generated Cypher query through to the persistent cache."""
+        embedding = query_vector.tobytes() if query_vector is not None else None
+        try:
+            with closing(sqlite3.connect(self.cypher_cache_path)) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cypher_cache (cache_key, prompt_digest, embedding, cypher, params, ts) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (cache_key, self._cache_key_prefix.hex(), embedding, cypher_query[0], json.dumps(cypher_query[1]),
+                     time.time())
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Could not persist Cypher query: {e}")
     
     def _should_refine_query(self, results: List[Dict], user_query: str) -> bool:
         """Determine if query refinement is needed based on initial results."""
@@ -87,57 +521,60 @@ class GraphRetriever:
             
         # Check if results are likely related to the user query
         # This is a simple heuristic - could be made more sophisticated
-        query_terms = set(user_query.lower().split())
-        result_terms = set()
+        query_terms = frozenset(user_query.casefold().split())
+        overlap = set()
         
-        # Extract terms from results
-        for result in results[:5]:  # Check first 5 results
-            for value in result.values():
-                if isinstance(value, str):
-                    result_terms.update(value.lower().split())
+        # Collect the query terms found in the results
+        if query_terms:
+            for result in results[:5]:  # Check first 5 results
+                for value in result.values():
+                    if isinstance(value, str):
+                        overlap.update(query_terms.intersection(value.casefold().split()))
+                        # Once the overlap is high enough, the remaining values can't change the outcome
+                        if len(overlap) / len(query_terms) >= REFINEMENT_OVERLAP_THRESHOLD:
+                            return False
         
-        # Calculate overlap between query terms and result terms
-        overlap = query_terms.intersection(result_terms)
+        # The overlap ratio is low, so refine the query
         overlap_ratio = len(overlap) / len(query_terms) if query_terms else 0
-        
-        # If overlap ratio is low, refine the query
-        if overlap_ratio < 0.3:  # Threshold can be adjusted
-            logger.info(f"Low term overlap ({overlap_ratio:.2f}) - refinement needed")
-            return True
-            
-        return False
+        logger.info(f"Low term overlap ({overlap_ratio:.2f}) - refinement needed")
+        return True
     
-    def _refine_cypher_query(self, user_query: str, initial_query: str, initial_results: List[Dict]) -> Optional[str]:
+    async def _refine_cypher_query(self, user_query: str, initial_query: CypherQuery,
+                                   initial_results: List[Dict]) -> Optional[CypherQuery]:
         """Refine a Cypher query based on initial results."""
         try:
-            # Prepare sample results for the prompt
-            sample_results_str = json.dumps(initial_results[:3], indent=2) if initial_results else "No results"
+            # Show the model the query as it ran, with parameter values in place
+            initial_query_text, initial_params = initial_query
+            for name, value in initial_params.items():
+                initial_query_text = initial_query_text.replace(f"${name}", json.dumps(value))
+            
+            # Prepare sample results for the prompt: compact JSON with long values cut short, as every character
+            # is prefilled by Codestral
+            sample_results = [
+                {
+                    key: value[:SAMPLE_VALUE_MAX_CHARS] + "..." if isinstance(value, str) and len(value) > SAMPLE_VALUE_MAX_CHARS else value
+                    for key, value in result.items()
+                }
+                for result in initial_results[:3]
+            ]
+            sample_results_str = json.dumps(sample_results, separators=(",", ":"), default=str) if initial_results else "No results"
             
             # Create refinement prompt
             refinement_prompt = self.hyde_refinement_prompt.format(
                 user_question=user_query,
-                initial_query=initial_query,
+                initial_query=initial_query_text,
                 result_count=len(initial_results),
                 sample_results=sample_results_str
             )
             
             logger.info("Generating refined Cypher query")
-            response = ollama.chat(model="codestral", messages=[{"role": "user", "content": refinement_prompt}])
-            refined_query = response["message"]["content"].strip()
+            refined_query = _extract_cypher(await self._chat_until_fence_closes(refinement_prompt))
             
-            # Clean up the refined query
-            if "```" in refined_query:
-                parts = refined_query.split("```")
-                if len(parts) >= 3:
-                    refined_query = parts[1]
-                    if refined_query.startswith("cypher"):
-                        refined_query = refined_query[6:]
-                    refined_query = refined_query.strip()
-            
-            # Validate the refined query
-            if self._validate_cypher_query(refined_query) and refined_query != initial_query:
-                logger.info(f"Successfully refined query: {refined_query}")
-                return refined_query
+            # Validate the refined query, keeping the case-insensitive rewrite validation may return
+            validated_query = self._validate_cypher_query(refined_query)
+            if validated_query is not None and validated_query != initial_query_text:
+                logger.info(f"Successfully refined query: {validated_query}")
+                return validated_query, {}
             else:
                 logger.info("Refined query validation failed or no change - using initial query")
                 return initial_query
@@ -146,7 +583,7 @@ class GraphRetriever:
             logger.error(f"Error refining Cypher query: {e}")
             return initial_query  # Fall back to the initial query
     
-    def _generate_cypher_query(self, user_query: str) -> Optional[str]:
+    async def _generate_cypher_query(self, user_query: str) -> Tuple[Optional[CypherQuery], bool]:
         """
         Generate a Cypher query using HyDE approach.
         
@@ -154,7 +591,7 @@ class GraphRetriever:
             user_query: User's natural language question
             
         Returns:
-            Generated Cypher query or None if generation failed
+            Tuple containing (Cypher query with parameters or None if generation failed, whether Codestral answered)
         """
         try:
             # Combine the system prompt with the user query to generate a Cypher query
@@ -163,34 +600,100 @@ class GraphRetriever:
             
             # Get the Cypher query from the LLM
             logger.info("Requesting Cypher query from Codestral")
-            response = ollama.chat(model="codestral", messages=[{"role": "user", "content": hyde_prompt}])
-            cypher_query = response["message"]["content"].strip()
-            
             # Extract just the Cypher query (remove any explanations)
-            if "```" in cypher_query:
-                # Extract code between backticks if present
-                parts = cypher_query.split("```")
-                if len(parts) >= 3:  # Proper code block with start and end ticks
-                    cypher_query = parts[1]
-                    if cypher_query.startswith("cypher"):
-                        cypher_query = cypher_query[6:]  # Remove "cypher" language identifier
-                    cypher_query = cypher_query.strip()
+            cypher_query = _extract_cypher(await self._chat_until_fence_closes(hyde_prompt))
             
             logger.info(f"Generated Cypher query: {cypher_query}")
+            return self._validated_cypher_query(user_query, cypher_query), True
             
-            # Basic validation of the query
-            if not self._validate_cypher_query(cypher_query):
-                logger.warning("Generated Cypher query failed validation")
-                cypher_query = self._generate_fallback_query(user_query)
-                logger.info(f"Using fallback query: {cypher_query}")
+        except Exception as e:
+            logger.error(f"Error generating Cypher query: {e}", exc_info=True)
+            return self._generate_fallback_query(user_query), False
+    
+    async def _chat_until_fence_closes(self, prompt: str) -> str:
+        """
+        Stream a Codestral answer, stopping as soon as its first fenced code block is closed.
+        
+        Only the code block is used, so any explanation after it is not worth waiting for;
+        closing the stream makes Ollama stop generating.
+        
+        Args:
+            prompt: Prompt to send as the user message
             
-            return cypher_query
+        Returns:
+            The answer up to and including the closing fence, or the whole answer if it has none
+        """
+        answer = ""
+        response_stream = await self.aclient.chat(model="codestral", messages=[{"role": "user", "content": prompt}], stream=True)
+        try:
+            async for chunk in response_stream:
+                answer += chunk["message"]["content"]
+                if answer.count("```") >= 2:
+                    logger.debug("Code block closed - stopping Codestral generation")
+                    break
+        finally:
+            await response_stream.aclose()
+        return answer
+    
+    async def _generate_cypher_queries_batch(self, user_queries: List[str]) -> List[Tuple[Optional[CypherQuery], bool]]:
+        """
+        Generate Cypher queries for several questions with a single Codestral call.
+        
+        The HyDE system prompt is evaluated once for the whole batch instead of once per question.
+        
+        Args:
+            user_queries: User questions
             
+        Returns:
+            List of (Cypher query, whether Codestral answered) tuples, in the order of user_queries
+        """
+        if len(user_queries) == 1:
+            return [await self._generate_cypher_query(user_queries[0])]
+        
+        try:
+            numbered_questions = "\n".join(f"[{i}] {user_query}" for i, user_query in enumerate(user_queries, 1))
+            batch_prompt = (
+                f"{self.hyde_system_prompt}\n\n"
+                "Generate one Cypher query for each numbered user question below. Respond with one ```cypher block "
+                "per question, each preceded by the question's number in brackets ([1], [2], ...).\n\n"
+                f"User questions:\n{numbered_questions}"
+            )
+            logger.info(f"Requesting Cypher queries for {len(user_queries)} questions from Codestral")
+            response = await self.aclient.chat(model="codestral", messages=[{"role": "user", "content": batch_prompt}])
+            parsed = {
+                int(number): cypher_query.strip()
+                for number, cypher_query in _BATCH_CYPHER_RE.findall(response["message"]["content"])
+            }
         except Exception as e:
-            logger.error(f"Error generating Cypher query: {e}", exc_info=True)
-            return self._generate_fallback_query(user_query)
+            logger.error(f"Error generating batched Cypher queries: {e}", exc_info=True)
+            parsed = {}
+        
+        results = [None] * len(user_queries)
+        for i, user_query in enumerate(user_queries):
+            if parsed.get(i + 1):
+                logger.info(f"Generated Cypher query [{i + 1}]: {parsed[i + 1]}")
+                results[i] = (self._validated_cypher_query(user_query, parsed[i + 1]), True)
+        
+        # Questions the batched answer skipped get a call of their own
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            logger.warning(f"Batched Cypher generation missed {len(missing)} of {len(user_queries)} questions")
+            retried = await asyncio.gather(*[self._generate_cypher_query(user_queries[i]) for i in missing])
+            for i, result in zip(missing, retried):
+                results[i] = result
+        return results
     
-    def _validate_cypher_query(self, cypher_query: str) -> bool:
+    def _validated_cypher_query(self, user_query: str, cypher_query: str) -> CypherQuery:
+        """Return the generated query as validation left it if it passes, otherwise the fallback query."""
+        validated_query = self._validate_cypher_query(cypher_query)
+        if validated_query is None:
+            logger.warning("Generated Cypher query failed validation")
+            fallback_query = self._generate_fallback_query(user_query)
+            logger.info(f"Using fallback query: {fallback_query[0]} with {fallback_query[1]}")
+            return fallback_query
+        return validated_query, {}
+    
+    def _validate_cypher_query(self, cypher_query: str) -> Optional[str]:
         """
         Perform basic validation on a Cypher query.
         
@@ -198,53 +701,37 @@ class GraphRetriever:
             cypher_query: Cypher query to validate
             
         Returns:
-            True if query appears to be valid, False otherwise
+            The query, rewritten for case-insensitive matching where needed, if it appears to be valid,
+            otherwise None
         """
         # Check for required Cypher components
-        required_keywords = ["MATCH", "RETURN", "LIMIT"]
-        if not all(keyword in cypher_query.upper() for keyword in required_keywords):
+        if not _REQUIRED_RE.match(cypher_query):
             logger.warning("Query validation failed: missing required components")
-            return False
+            return None
         
         # Check for invalid property references
-        invalid_properties = ["description", "comments", "content", "body", "type"]
-        for prop in invalid_properties:
-            if f".{prop}" in cypher_query:
-                logger.warning(f"Query validation failed: contains invalid property '{prop}'")
-                return False
+        invalid_property = _BAD_PROP_RE.search(cypher_query)
+        if invalid_property:
+            logger.warning(f"Query validation failed: contains invalid property '{invalid_property.group(1)}'")
+            return None
         
         # Check if query uses case-insensitive matching with toLower() - add this
-        if ("CONTAINS" in cypher_query.upper() or "STARTS WITH" in cypher_query.upper()) and "toLower" not in cypher_query:
+        if "toLower" not in cypher_query and _STRING_OPERATOR_RE.search(cypher_query):
             logger.info("Enhancing query with case-insensitive matching")
             return self._enhance_with_case_insensitivity(cypher_query)
         
-        return True
+        return cypher_query
     
     def _enhance_with_case_insensitivity(self, cypher_query: str) -> str:
         """Add case-insensitive matching to a query that doesn't have it."""
         # This is a simple implementation - a more robust version would use a parser
-        modified_query = cypher_query
-        
-        # Replace string comparisons with case-insensitive versions
-        import re
-        
-        # Pattern for string comparisons in WHERE clauses
-        patterns = [
-            (r'(WHERE\s+)(\w+\.\w+)\s+CONTAINS\s+(["\'])(.+?)(["\'])', 
-             r'\1toLower(\2) CONTAINS toLower(\3\4\5)'),
-            (r'(WHERE\s+)(\w+\.\w+)\s+STARTS\s+WITH\s+(["\'])(.+?)(["\'])', 
-             r'\1toLower(\2) STARTS WITH toLower(\3\4\5)'),
-            (r'(OR\s+)(\w+\.\w+)\s+CONTAINS\s+(["\'])(.+?)(["\'])', 
-             r'\1toLower(\2) CONTAINS toLower(\3\4\5)')
-        ]
-        
-        for pattern, replacement in patterns:
-            modified_query = re.sub(pattern, replacement, modified_query, flags=re.IGNORECASE)
+        # Replace string comparisons with case-insensitive versions in a single pass
+        modified_query = _STRING_COMPARISON_RE.sub(_case_insensitive_comparison, cypher_query)
         
         logger.info(f"Enhanced query with case-insensitivity: {modified_query}")
         return modified_query
     
-    def _generate_fallback_query(self, user_query: str) -> str:
+    def _generate_fallback_query(self, user_query: str) -> CypherQuery:
         """
         Generate a simple, reliable fallback query based on user input.
         
@@ -252,34 +739,26 @@ class GraphRetriever:
             user_query: User's natural language question
             
         Returns:
-            A simple Cypher query that's unlikely to fail
+            A simple Cypher query that's unlikely to fail, with its parameters
         """
-        # Extract potential keywords from user query
-        keywords = user_query.split()
-        search_term = ""
-        
-        # Use longest word as potential class/method name (simple heuristic)
-        if keywords:
-            search_term = max(keywords, key=len)
-            if len(search_term) < 3:  # If all words are very short, use the whole query
-                search_term = user_query
+        # Use longest word as potential class/method name (simple heuristic);
+        # if all words are very short, use the whole query
+        search_term = max((word for word in user_query.split() if len(word) >= 3), key=len, default=user_query)
         
         # Safe, simple query that's unlikely to fail
-        return f"""
-        MATCH (m:Method)
-        WHERE toLower(m.name) CONTAINS toLower("{search_term}") OR toLower(m.docstring) CONTAINS toLower("{search_term}") 
-        MATCH (c:Class)-[:CONTAINS]->(m)
-        MATCH (n:Namespace)-[:CONTAINS]->(c)
-        RETURN n.name AS Namespace, c.name AS Class, m.name AS Method
-        LIMIT 50
-        """
+        if FALLBACK_TEXT_INDEXES <= self._text_indexed_properties:
+            return FALLBACK_QUERY_TEXT_INDEXED, {"term": search_term, "k": DEFAULT_TOP_K}
+        return FALLBACK_QUERY, {"term": search_term, "k": DEFAULT_TOP_K}
     
-    def _execute_cypher_query(self, cypher_query: str) -> List[Dict[str, Any]]:
+    def _execute_cypher_query(self, cypher_query: str, params: Optional[Dict[str, Any]] = None,
+                              fallback_query: Optional[CypherQuery] = None) -> List[Dict[str, Any]]:
         """
         Execute a Cypher query against Neo4j and process the results.
         
         Args:
             cypher_query: Cypher query to execute
+            params: Query parameters
+            fallback_query: Query with its parameters to run instead if this one fails
             
         Returns:
             List of dictionaries containing query results
@@ -289,37 +768,32 @@ class GraphRetriever:
             return []
             
         try:
-            with self.driver.session() as session:
-                logger.debug("Executing Cypher query")
-                results = session.run(cypher_query)
-                
-                # Convert results to a more structured format for analysis
-                code_items = []
-                for record in results:
-                    # Create a structured dictionary from the record
-                    item = {}
-                    for key in record.keys():
-                        item[key] = record[key]
-                    code_items.append(item)
-                
-                logger.info(f"Neo4j returned {len(code_items)} results")
-                return code_items
+            logger.debug("Executing Cypher query")
+            code_items = self._run_read_query(cypher_query, params)
+            
+            logger.info(f"Neo4j returned {len(code_items)} results")
+            return code_items
                 
         except Exception as db_error:
             logger.error(f"Neo4j query execution failed: {db_error}")
             # Try with simpler fallback if original query failed
+            if fallback_query is None or fallback_query == (cypher_query, params):
+                return []
             try:
-                cypher_query = self._generate_fallback_query(user_query="code")
-                logger.info(f"Trying simple fallback query: {cypher_query}")
-                with self.driver.session() as session:
-                    results = session.run(cypher_query)
-                    code_items = []
-                    for record in results:
-                        item = {}
-                        for key in record.keys():
-                            item[key] = record[key]
-                        code_items.append(item)
-                    return code_items
+                cypher_query, params = fallback_query
+                logger.info(f"Trying simple fallback query: {cypher_query} with {params}")
+                return self._run_read_query(cypher_query, params)
             except Exception as e:
                 logger.error(f"Fallback query also failed: {e}")
-                return []
\ No newline at end of file
+                return []
+    
+    def _run_read_query(self, cypher_query: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Run a query in a read transaction and return one dictionary per record."""
+        # execute_query borrows a pooled connection for just this query and retries transient failures
+        return self.driver.execute_query(
+            cypher_query,
+            params,
+            database_=NEO4J_DATABASE,
+            routing_=RoutingControl.READ,
+            result_transformer_=Result.data
+        )
\ No newline at end of file
@@ -1,22 +1,148 @@
+import asyncio
 import logging
-from typing import List, Dict, Any, Optional, Tuple
+import numpy as np
+from functools import lru_cache
+from itertools import chain
+from typing import Iterator, List, Dict, Any, Optional, Tuple
 from langchain.vectorstores import Chroma
 from langchain.schema import Document
 
+try:
+    import faiss
+except ImportError:  # Optional: only the FAISS-backed unfiltered search needs it
+    faiss = None
+
+# Messages use %-style arguments, so nothing is formatted on the per-query path unless the level is enabled
 logger = logging.getLogger("rag_chatbot.vector_search")
 
+# Shared stand-in for missing name and docstring lists; only ever iterated
+_EMPTY: tuple = ()
+
+# Most tokens the Neo4j enhancements may add to the question, when the embedding model's tokenizer is available;
+# every extra token is encoder work on each query
+ENHANCEMENT_MAX_TOKENS = 128
+
+# Character cap on the enhancements when token counts aren't available (about 100 tokens, leaving room for the question)
+ENHANCEMENT_MAX_CHARS = 400
+
+# Rough characters per token, used to stop collecting enhancements before they are tokenized
+CHARS_PER_TOKEN = 4
+
+# Candidates fetched per requested result when chunks of the exact Class::Method pairs are ranked first
+FILTER_OVERSAMPLE = 3
+
+# Filtering on at most this many names is tried on an unfiltered search first, filtered in Python
+POSTFILTER_MAX_NAMES = 64
+
+# Unfiltered candidates fetched per needed filtered result for that post-filtering
+POSTFILTER_OVERSAMPLE = 8
+
+def qualname(class_name: str, method_name: str) -> str:
+    """Composite "Class::Method" key stored in each chunk's metadata by ingest.py."""
+    return f"{class_name}::{method_name}"
+
+def hnsw_collection_metadata(num_vectors: int) -> Dict[str, Any]:
+    """
+    Chroma collection metadata with HNSW parameters sized for the expected number of vectors.
+    
+    Args:
+        num_vectors: Number of embeddings the collection will hold
+        
+    Returns:
+        Metadata dictionary to pass as collection_metadata when the collection is created
+    """
+    # Chroma's defaults (M=16, construction_ef=100, search_ef=10) trade too much recall for speed on code chunks
+    if num_vectors <= 100_000:
+        m, construction_ef, search_ef = 24, 128, 100
+    else:
+        m, construction_ef, search_ef = 32, 200, 128
+    
+    return {
+        "hnsw:space": "cosine",
+        "hnsw:M": m,
+        "hnsw:construction_ef": construction_ef,
+        "hnsw:search_ef": search_ef
+    }
+
+@lru_cache(maxsize=256)
+def _filter_dict(method_names: frozenset, class_names: frozenset) -> Dict[str, Any]:
+    """
+    Chroma metadata filter for the given names, cached so repeated questions reuse the same dict.
+    
+    Callers must treat the returned dict as read-only; Chroma only reads it.
+    """
+    if method_names and class_names:
+        # Documents matching either name
+        return {
+            "$or": [
+                {"method_name": {"$in": sorted(method_names)}},
+                {"class_name": {"$in": sorted(class_names)}}
+            ]
+        }
+    if method_names:
+        return {"method_name": {"$in": sorted(method_names)}}
+    return {"class_name": {"$in": sorted(class_names)}}
+
+def build_faiss_index(vector_db: Chroma) -> Tuple["faiss.Index", List[Document]]:
+    """
+    Copy the embeddings of a Chroma collection into an exact inner-product FAISS index.
+    
+    Args:
+        vector_db: Chroma store whose embeddings are L2-normalized, so inner product is cosine similarity
+        
+    Returns:
+        Tuple containing (FAISS index, documents in index row order)
+    """
+    if faiss is None:
+        raise ImportError("faiss is not installed - pip install faiss-cpu")
+    
+    data = vector_db.get(include=["embeddings", "documents", "metadatas"])
+    if not data["ids"]:
+        raise ValueError("Chroma collection is empty")
+    
+    embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    index.add(embeddings)
+    documents = [
+        Document(page_content=text, metadata=metadata or {})
+        for text, metadata in zip(data["documents"], data["metadatas"])
+    ]
+    return index, documents
+
 class EnhancedVectorRetriever:
     """A specialized retriever that enhances queries with metadata from Neo4j and uses filters."""
     
-    def __init__(self, vector_db: Chroma):
+    def __init__(self, vector_db: Chroma, faiss_index: Optional["faiss.Index"] = None,
+                 faiss_documents: Optional[List[Document]] = None, use_postfilter: bool = True):
+        """
+        Initialize the retriever.
+        
+        Args:
+            vector_db: Chroma store, used for every search with a metadata filter
+            faiss_index: Optional FAISS copy of the store's embeddings (see build_faiss_index) answering
+                unfiltered searches without Chroma's metadata layer
+            faiss_documents: Documents in faiss_index row order
+            use_postfilter: Whether to answer searches filtered on a few names from an over-fetched unfiltered
+                search, whose traversal is cheaper than Chroma's filtered one, before running the filtered search
+        """
         self.vector_db = vector_db
+        self.faiss_index = faiss_index
+        self.faiss_documents = faiss_documents
+        self.use_postfilter = use_postfilter
+        
+        # The embedding model's thread-safe token counter, if it has one (OnnxMiniLMEmbeddings does), to budget
+        # queries in tokens
+        embeddings = getattr(vector_db, "embeddings", None)
+        self._count_tokens = getattr(embeddings, "count_tokens", None)
+        self._max_seq_length = getattr(embeddings, "max_seq_length", 512)
     
     def retrieve(self, 
                  user_question: str, 
                  method_names: List[str] = None,
                  class_names: List[str] = None,
                  method_docstrings: List[str] = None,
-                 k: int = 3) -> Tuple[List[Document], str]:
+                 k: int = 3,
+                 qualnames: List[str] = None) -> Tuple[List[Document], str]:
         """
         Perform enhanced vector retrieval using Neo4j metadata.
         
@@ -26,13 +152,17 @@ class EnhancedVectorRetriever:
             class_names: List of class names from Neo4j
             method_docstrings: List of method docstrings from Neo4j
             k: Number of results to retrieve
+            qualnames: "Class::Method" keys (see qualname) of the method rows from Neo4j; their chunks rank first
             
         Returns:
             Tuple containing (vector_results, enhanced_query)
         """
-        method_names = method_names or []
-        class_names = class_names or []
-        method_docstrings = method_docstrings or []
+        # Neo4j results repeat names; dedup once (keeping order) so the $in filters and the query stay small
+        # Missing inputs share one empty tuple instead of each getting a new list
+        method_names = list(dict.fromkeys(method_names)) if method_names else _EMPTY
+        class_names = list(dict.fromkeys(class_names)) if class_names else _EMPTY
+        method_docstrings = method_docstrings or _EMPTY
+        qualnames = frozenset(qualnames) if qualnames else _EMPTY
         
         # Create enhanced query with semantic context
         enhanced_query = self._build_enhanced_query(
@@ -42,17 +172,77 @@ class EnhancedVectorRetriever:
             method_docstrings
         )
         
+        # Embed the query once; every search below, including the fallbacks, reuses the vector
+        query_embedding = self.vector_db.embeddings.embed_query(enhanced_query)
+        
         # Retrieve results with metadata filtering
         vector_results = self._retrieve_with_filters(
-            enhanced_query,
+            query_embedding,
             method_names,
             class_names,
+            qualnames,
             k
         )
         
-        logger.info(f"Vector search returned {len(vector_results)} results")
+        logger.info("Vector search returned %d results", len(vector_results))
         return vector_results, enhanced_query
     
+    async def aretrieve(self,
+                        user_question: str,
+                        method_names: List[str] = None,
+                        class_names: List[str] = None,
+                        method_docstrings: List[str] = None,
+                        k: int = 3,
+                        qualnames: List[str] = None) -> Tuple[List[Document], str]:
+        """
+        Like retrieve, without blocking the event loop.
+        
+        Chroma's client and the embedding model block, so the retrieval runs in a worker thread.
+        
+        Returns:
+            Tuple containing (vector_results, enhanced_query)
+        """
+        return await asyncio.to_thread(
+            self.retrieve, user_question, method_names, class_names, method_docstrings, k, qualnames
+        )
+    
+    async def aretrieve_many(self, user_questions: List[str], **kwargs) -> List[Tuple[List[Document], str]]:
+        """
+        Retrieve for several questions concurrently.
+        
+        Args:
+            user_questions: User questions
+            **kwargs: Further retrieve arguments, shared by all questions
+            
+        Returns:
+            List of (vector_results, enhanced_query) per question, in the order of user_questions
+        """
+        return await asyncio.gather(*[self.aretrieve(user_question, **kwargs) for user_question in user_questions])
+    
+    def retrieve_many(self, user_questions: List[str], **kwargs) -> List[Tuple[List[Document], str]]:
+        """Blocking wrapper around aretrieve_many for callers without a running event loop."""
+        return asyncio.run(self.aretrieve_many(user_questions, **kwargs))
+    
+    def warmup(self, k: int = 32) -> None:
+        """
+        Run one throwaway search so the first question doesn't pay for a cold index.
+        
+        The probe query loads the embedding model, and fetching k neighbours pages in a larger part of Chroma's
+        memory-mapped HNSW graph than a single-result search would.
+        
+        Args:
+            k: Number of neighbours to fetch
+        """
+        query_embedding = self.vector_db.embeddings.embed_query("warm up")
+        self.vector_db.similarity_search_by_vector(query_embedding, k=k)
+    
+    def clear_embedding_cache(self) -> None:
+        """Drop the query embeddings cached by the vector store's embeddings, if they keep any."""
+        # OnnxMiniLMEmbeddings caches query embeddings in an LRU keyed by the normalized text
+        clear_query_cache = getattr(self.vector_db.embeddings, "clear_query_cache", None)
+        if clear_query_cache is not None:
+            clear_query_cache()
+    
     def _build_enhanced_query(self, 
                              user_question: str,
                              method_names: List[str],
@@ -62,168 +252,168 @@ class EnhancedVectorRetriever:
         # Start with original user question
         enhanced_query = user_question
         
-        # Create a semantic-rich enhanced query
-        semantic_enhancements = []
-        
-        # Add entity names (method names and class names)
-        if method_names:
-            semantic_enhancements.extend(method_names)
-        if class_names:
-            semantic_enhancements.extend(class_names)
-        
-        # Add method docstrings (but limit their length to avoid overwhelming the query)
-        for docstring in method_docstrings:
-            # Extract the first sentence or up to 100 characters from each docstring
-            if docstring:
-                first_sentence = docstring.split('.')[0] if '.' in docstring else docstring
-                if len(first_sentence) > 100:
-                    first_sentence = first_sentence[:100]
-                semantic_enhancements.append(first_sentence)
-        
-        # Add all enhancements to the query, but avoid making it too long
-        if semantic_enhancements:
-            # Join all enhancements but limit total length
-            enhancements_text = " ".join(set(semantic_enhancements)) # Use set to avoid duplicates
-            if len(enhancements_text) > 500:  # Reasonable limit for embedding models
-                enhancements_text = enhancements_text[:500]
+        # Entity names (method names and class names), then the first sentence (up to 100 characters) of each
+        # method docstring, so a long docstring doesn't overwhelm the query
+        semantic_enhancements = chain(
+            method_names,
+            class_names,
+            ((docstring.partition('.')[0] or docstring)[:100] for docstring in method_docstrings if docstring)
+        )
+        
+        # Take distinct enhancements in order until the text reaches the budget, without building or
+        # deduplicating the terms that would be cut off
+        max_chars = ENHANCEMENT_MAX_TOKENS * CHARS_PER_TOKEN if self._count_tokens is not None else ENHANCEMENT_MAX_CHARS
+        # One dict is both the membership check and the ordered result, which " ".join reads directly
+        enhancements = {}
+        length = 0
+        for enhancement in semantic_enhancements:
+            if enhancement in enhancements:
+                continue
+            enhancements[enhancement] = None
+            length += len(enhancement) + 1
+            if length >= max_chars:
+                break
+        
+        if self._count_tokens is not None:
+            enhancements_text = " ".join(self._within_token_budget(user_question, list(enhancements)))
+        else:
+            enhancements_text = " ".join(enhancements)[:max_chars]
+        if enhancements_text:
             enhanced_query += " " + enhancements_text
         
-        logger.info(f"Enhanced query for vector search: {enhanced_query[:100]}...")  # Log first 100 chars
+        logger.info("Enhanced query for vector search: %.100s...", enhanced_query)  # Log first 100 chars
         return enhanced_query
     
+    def _within_token_budget(self, user_question: str, enhancements: List[str]) -> List[str]:
+        """Longest prefix of the enhancements whose tokens fit next to the question in the embedding model's input."""
+        if not enhancements:
+            return enhancements
+        
+        # The question's count includes the special tokens; whitespace-separated terms tokenize independently
+        question_tokens = self._count_tokens([user_question])[0]
+        budget = min(ENHANCEMENT_MAX_TOKENS, self._max_seq_length - question_tokens)
+        
+        total = 0
+        for i, token_count in enumerate(self._count_tokens(enhancements, add_special_tokens=False)):
+            total += token_count
+            if total > budget:
+                return enhancements[:i]
+        return enhancements
+    
     def _retrieve_with_filters(self,
-                              enhanced_query: str,
+                              query_embedding: List[float],
                               method_names: List[str], 
                               class_names: List[str],
+                              qualnames: frozenset,
                               k: int) -> List[Document]:
         """Retrieve documents using metadata filtering based on Neo4j results."""
         try:
-            # Now implement metadata filtering for more precise results
-            if method_names or class_names:
-                logger.info("Using metadata filters from Neo4J results")
-                
-                # Case 1: If we have both method and class names
-                if method_names and class_names:
-                    return self._retrieve_with_method_and_class_filters(
-                        enhanced_query, method_names, class_names, k
-                    )
-                
-                # Case 2: If we only have method names
-                elif method_names:
-                    return self._retrieve_with_method_filters(
-                        enhanced_query, method_names, k
-                    )
-                
-                # Case 3: If we only have class names
-                elif class_names:
-                    return self._retrieve_with_class_filters(
-                        enhanced_query, class_names, k
-                    )
-            
             # Standard similarity search if we don't have metadata
-            return self.vector_db.similarity_search(enhanced_query, k=k)
+            if not method_names and not class_names:
+                return self._search_unfiltered(query_embedding, k)
             
-        except Exception as e:
-            logger.error(f"Error in vector retrieval: {e}", exc_info=True)
-            # Fall back to standard search without filters
-            logger.info("Falling back to standard search without filters")
-            return self.vector_db.similarity_search(enhanced_query, k=k)
-    
-    def _retrieve_with_method_and_class_filters(self,
-                                               enhanced_query: str,
-                                               method_names: List[str],
-                                               class_names: List[str],
-                                               k: int) -> List[Document]:
-        """Retrieve with both method and class filters."""
-        try:
-            # First try to find exact matches with both filters
-            filter_conditions = {
-                "$and": [
-                    {"method_name": {"$in": method_names}},
-                    {"class_name": {"$in": class_names}}
-                ]
-            }
+            logger.debug("Using metadata filters from Neo4J results")
             
-            vector_results = self.vector_db.similarity_search(
-                enhanced_query,
-                k=k,
-                filter=filter_conditions
-            )
+            method_names, class_names = frozenset(method_names), frozenset(class_names)
+            # The filter matches either name; over-fetch so the chunks of the exact pairs can be ranked first
+            fetch_k = k * FILTER_OVERSAMPLE if qualnames else k
             
-            # If no results, fall back to OR condition
-            if not vector_results:
-                filter_conditions = {
-                    "$or": [
-                        {"method_name": {"$in": method_names}},
-                        {"class_name": {"$in": class_names}}
-                    ]
-                }
-                vector_results = self.vector_db.similarity_search(
-                    enhanced_query,
-                    k=k,
-                    filter=filter_conditions
+            vector_results = None
+            if self.use_postfilter and len(method_names) + len(class_names) <= POSTFILTER_MAX_NAMES:
+                vector_results = self._postfiltered_search(query_embedding, method_names, class_names, fetch_k)
+            
+            if vector_results is None:
+                # Build the metadata filter once, so every case goes through the same single search
+                vector_results = self.vector_db.similarity_search_by_vector(
+                    query_embedding,
+                    k=fetch_k,
+                    filter=_filter_dict(method_names, class_names)
                 )
             
+            if qualnames:
+                vector_results = self._rank_qualnames_first(vector_results, qualnames)[:k]
             return vector_results
             
         except Exception as e:
-            logger.error(f"Error with combined method/class filtering: {e}")
-            # Fall back to standard search
-            return self.vector_db.similarity_search(enhanced_query, k=k)
-    
-    def _retrieve_with_method_filters(self,
-                                     enhanced_query: str,
-                                     method_names: List[str],
-                                     k: int) -> List[Document]:
-        """Retrieve with method name filters."""
-        try:
-            filter_conditions = {"method_name": {"$in": method_names}}
-            return self.vector_db.similarity_search(
-                enhanced_query,
-                k=k,
-                filter=filter_conditions
-            )
-        except Exception as e:
-            logger.error(f"Error with method name filtering: {e}")
-            return self.vector_db.similarity_search(enhanced_query, k=k)
-    
-    def _retrieve_with_class_filters(self,
-                                    enhanced_query: str,
-                                    class_names: List[str],
-                                    k: int) -> List[Document]:
-        """Retrieve with class name filters."""
-        try:
-            filter_conditions = {"class_name": {"$in": class_names}}
-            return self.vector_db.similarity_search(
-                enhanced_query,
-                k=k,
-                filter=filter_conditions
-            )
-        except Exception as e:
-            logger.error(f"Error with class name filtering: {e}")
-            return self.vector_db.similarity_search(enhanced_query, k=k)
+            logger.error("Error in vector retrieval: %s", e, exc_info=True)
+            # Fall back to standard search without filters
+            logger.info("Falling back to standard search without filters")
+            return self._search_unfiltered(query_embedding, k)
+    
+    def _postfiltered_search(self,
+                             query_embedding: List[float],
+                             method_names: frozenset,
+                             class_names: frozenset,
+                             fetch_k: int) -> Optional[List[Document]]:
+        """
+        Apply the metadata filter to an over-fetched unfiltered search.
+        
+        Args:
+            query_embedding: Embedding of the enhanced query
+            method_names: Method names to match
+            class_names: Class names to match
+            fetch_k: Number of filtered results needed
+            
+        Returns:
+            The fetch_k nearest matching documents, the same ones the filtered search would return, or None if the
+            candidates hold too few matches to be sure of that
+        """
+        candidate_k = fetch_k * POSTFILTER_OVERSAMPLE
+        candidates = self._search_unfiltered(query_embedding, candidate_k)
+        
+        # Same semantics as _filter_dict: a document matches if either of its names is given
+        matches = [
+            doc for doc in candidates
+            if doc.metadata.get("method_name") in method_names or doc.metadata.get("class_name") in class_names
+        ]
+        
+        # Fewer candidates than asked for means the whole collection was searched
+        if len(matches) >= fetch_k or len(candidates) < candidate_k:
+            return matches[:fetch_k]
+        
+        logger.debug("Post-filtering found %d of %d results - running the filtered search", len(matches), fetch_k)
+        return None
+    
+    def _search_unfiltered(self, query_embedding: List[float], k: int) -> List[Document]:
+        """Nearest documents to the query embedding, from the FAISS index when there is one."""
+        if self.faiss_index is None:
+            return self.vector_db.similarity_search_by_vector(query_embedding, k=k)
+        
+        _, rows = self.faiss_index.search(np.asarray([query_embedding], dtype=np.float32), k)
+        # FAISS pads with -1 when the index holds fewer than k vectors
+        return [self.faiss_documents[row] for row in rows[0] if row >= 0]
+    
+    def _rank_qualnames_first(self, vector_results: List[Document], qualnames: frozenset) -> List[Document]:
+        """Stable partition: chunks of the given Class::Method pairs first, each group still in similarity order."""
+        pair_match, name_match = [], []
+        for doc in vector_results:
+            if doc.metadata.get("qualname") in qualnames:
+                pair_match.append(doc)
+            else:
+                name_match.append(doc)
+        return pair_match + name_match
     
     def format_results(self, vector_results: List[Document]) -> str:
         """Format vector results into a readable context string."""
-        vector_snippets = []
+        # The snippets are joined as they are generated, without collecting them in a list first
+        vector_context = "\n\n---\n\n".join(self._format_snippets(vector_results))
+        logger.debug("Vector context length: %d characters", len(vector_context))
         
+        return vector_context
+    
+    def _format_snippets(self, vector_results: List[Document]) -> Iterator[str]:
+        """Yield each vector result with its metadata, truncated to 800 characters."""
         for i, doc in enumerate(vector_results):
             content = doc.page_content
             metadata = doc.metadata
             
             # Add metadata to content for context
-            metadata_text = f"Method: {metadata.get('method_name', 'Unknown')} | Class: {metadata.get('class_name', 'Unknown')}"
-            enriched_content = f"{metadata_text}\n\n{content}"
+            metadata_text = f"Method: {metadata.get('method_name', 'Unknown')} | Class: {metadata.get('class_name', 'Unknown')}\n\n"
             
-            logger.debug(f"Vector result {i+1} length: {len(enriched_content)} characters")
+            logger.debug("Vector result %d length: %d characters", i + 1, len(metadata_text) + len(content))
             
             # Truncate long vector results
-            if len(enriched_content) > 800:
-                enriched_content = enriched_content[:800] + " [content truncated...]"
+            if len(metadata_text) + len(content) > 800:
+                content = content[:max(0, 800 - len(metadata_text))] + " [content truncated...]"
             
-            vector_snippets.append(enriched_content)
-        
-        vector_context = "\n\n---\n\n".join(vector_snippets)
-        logger.debug(f"Vector context length: {len(vector_context)} characters")
-        
-        return vector_context
\ No newline at end of file
+            yield metadata_text + content
\ No newline at end of file
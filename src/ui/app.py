@@ -6,10 +6,11 @@ st.title("🧑‍💻 Legacy Code Expert Chatbot")
 user_query = st.text_input("Ask a question about the code:")
 
 if user_query:
-    response = requests.get("http://localhost:8000/query/", params={"user_question": user_query})
+    response = requests.get("http://localhost:8000/query/", params={"user_question": user_query}, stream=True)
     
     if response.status_code == 200:
         st.write("### Answer:")
-        st.write(response.json()["answer"])
+        # Render the answer as it is generated
+        st.write_stream(response.iter_content(chunk_size=None, decode_unicode=True))
     else:
         st.error(f"Error fetching response. Status code: {response.status_code}, Content: {response.text}")